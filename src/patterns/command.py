@@ -10,6 +10,17 @@
     1.会产生大量命令类
 """
 
+import collections
+import copy
+import json
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+
 from src.utils import start_end
 
 
@@ -22,11 +33,38 @@ class CommandMixin(object):
     def undo(self):
         raise NotImplementedError
 
+    def get_receiver(self):
+        """命令的接收者，执行器按接收者保证顺序，None表示没有顺序要求"""
+        return None
+
+    def get_receivers(self):
+        """命令涉及的所有接收者，执行器按每个接收者保证顺序"""
+        receiver = self.get_receiver()
+        return [] if receiver is None else [receiver]
+
+    def journal_groups(self, action):
+        """
+        执行(或撤销)时写入的接收者状态组，日志压缩时一条记录的每个组都被后面的记录覆盖才能丢弃
+        None表示覆盖接收者的全部状态，只写部分状态的命令必须声明写了哪些组
+        """
+        return (None,)
+
+    def journal_args(self):
+        """除接收者外重建命令需要的参数，必须可以json序列化"""
+        return ()
+
+    @classmethod
+    def from_journal(cls, receiver, *args):
+        return cls(receiver, *args)
+
 
 class LightOnCommand(CommandMixin):
     def __init__(self, light):
         self.light = light
 
+    def get_receiver(self):
+        return self.light
+
     def execute(self):
         # 不直接实现细节，通过接受者light做处理，更加对调用者和接收者解耦
         self.light.on()
@@ -42,6 +80,9 @@ class LightOffCommand(CommandMixin):
     def __init__(self, light):
         self.light = light
 
+    def get_receiver(self):
+        return self.light
+
     def execute(self):
         self.light.off()
 
@@ -129,6 +170,8 @@ class RemoteControl(object):
 # 实现播放音响CD
 
 class Stereo(object):
+    volume = 0
+
     def on(self):
         print('stereo on...')
 
@@ -139,6 +182,7 @@ class Stereo(object):
         print('stereo set cd')
 
     def set_volume(self, volume):
+        self.volume = volume
         print('stereo set volume to %s' % volume)
 
 
@@ -146,6 +190,9 @@ class StereoOnCommand(CommandMixin):
     def __init__(self, stereo):
         self.stereo = stereo
 
+    def get_receiver(self):
+        return self.stereo
+
     def execute(self):
         self.stereo.on()
         self.stereo.set_cd()
@@ -154,6 +201,10 @@ class StereoOnCommand(CommandMixin):
     def undo(self):
         self.stereo.off()
 
+    def journal_groups(self, action):
+        # 打开时同时设置了音量
+        return ('power', 'volume') if action == EXECUTE else ('power',)
+
     def __str__(self):
         return 'stereo on'
 
@@ -162,6 +213,9 @@ class StereoOffCommand(CommandMixin):
     def __init__(self, stereo):
         self.stereo = stereo
 
+    def get_receiver(self):
+        return self.stereo
+
     def execute(self):
         self.stereo.off()
 
@@ -170,10 +224,53 @@ class StereoOffCommand(CommandMixin):
         self.stereo.set_cd()
         self.stereo.set_volume(12)
 
+    def journal_groups(self, action):
+        return ('power',) if action == EXECUTE else ('power', 'volume')
+
     def __str__(self):
         return 'stereo off'
 
 
+class StereoVolumeCommand(CommandMixin):
+    def __init__(self, stereo, volume):
+        self.stereo = stereo
+        self.volume = volume
+        self.pre_volume = None
+
+    def get_receiver(self):
+        return self.stereo
+
+    def execute(self):
+        self.pre_volume = self.stereo.volume
+        self.stereo.set_volume(self.volume)
+
+    def undo(self):
+        self.stereo.set_volume(self.pre_volume)
+
+    def merge(self, other):
+        """连续调音量合并成一条，撤销时直接回到最开始的音量"""
+        if isinstance(other, StereoVolumeCommand) and other.stereo is self.stereo:
+            merged = StereoVolumeCommand(self.stereo, other.volume)
+            merged.pre_volume = self.pre_volume
+            return merged
+        return None
+
+    def journal_groups(self, action):
+        return ('volume',)
+
+    def journal_args(self):
+        return self.volume, self.pre_volume
+
+    @classmethod
+    def from_journal(cls, stereo, volume, pre_volume):
+        command = cls(stereo, volume)
+        command.pre_volume = pre_volume
+        return command
+
+    def __str__(self):
+        return 'stereo volume %s' % self.volume
+
+
 # 使用组合命令
 class MacroCommand(CommandMixin):
     def __init__(self, commands):
@@ -187,6 +284,509 @@ class MacroCommand(CommandMixin):
         for command in self.commands[::-1]:
             command.undo()
 
+    def get_receiver(self):
+        # 所有命令是同一个接收者时才返回
+        receivers = self.get_receivers()
+        if len(receivers) == 1:
+            return receivers[0]
+        return None
+
+    def get_receivers(self):
+        receivers = {}
+        for command in self.commands:
+            for receiver in command.get_receivers():
+                receivers.setdefault(id(receiver), receiver)
+        return list(receivers.values())
+
+
+# 所有命令都在press_on中同步执行，没有用上命令模式的队列能力
+# 解决：命令执行器，有界队列+线程池，同一接收者的命令按提交顺序执行，不同接收者并行
+class CommandLane(object):
+    """同一接收者的待执行命令"""
+
+    def __init__(self):
+        self.pending = collections.deque()
+        self.running = False
+        # 队首是涉及多个接收者的命令，正在等其他接收者的队列轮到它
+        self.parked = False
+
+
+class CommandTask(object):
+    def __init__(self, command, future, lanes):
+        self.command = command
+        self.future = future
+        # [(key, lane)]，命令涉及的每个接收者的队列
+        self.lanes = lanes
+        # 还没轮到这个命令的队列数
+        self.remaining = len(lanes)
+
+
+class CommandExecutor(object):
+    """宏命令这类涉及多个接收者的命令，要在每个接收者的队列里都轮到时才执行"""
+
+    def __init__(self, max_workers=None, max_pending=1024):
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        # 限制已提交未完成的命令数，满了submit会阻塞
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()
+        # id(receiver) -> CommandLane，空了就删除
+        self.lanes = {}
+
+    def submit(self, command, timeout=None):
+        """返回Future，结果是execute的返回值；队列满且超时返回时抛出TimeoutError"""
+        if not self.slots.acquire(timeout=timeout):
+            raise TimeoutError('command queue is full')
+        future = Future()
+        receivers = command.get_receivers()
+        if not receivers:
+            self.pool.submit(self._run, command, future)
+            return future
+        start = []
+        with self.lock:
+            lanes = []
+            for receiver in receivers:
+                key = id(receiver)
+                lane = self.lanes.get(key)
+                if lane is None:
+                    lane = self.lanes[key] = CommandLane()
+                lanes.append((key, lane))
+            # 在锁内加入所有队列，多个宏命令在各队列中的先后顺序一致，不会互相等待
+            task = CommandTask(command, future, lanes)
+            for key, lane in lanes:
+                lane.pending.append(task)
+                if not lane.running and not lane.parked:
+                    lane.running = True
+                    start.append((key, lane))
+        for key, lane in start:
+            self.pool.submit(self._drain, key, lane)
+        return future
+
+    def _run(self, command, future):
+        try:
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(command.execute())
+                except BaseException as e:
+                    future.set_exception(e)
+        finally:
+            self.slots.release()
+
+    def _drain(self, key, lane):
+        while True:
+            restart = []
+            with self.lock:
+                if not lane.pending:
+                    lane.running = False
+                    del self.lanes[key]
+                    return
+                task = lane.pending[0]
+                task.remaining -= 1
+                if task.remaining:
+                    # 其他接收者的队列还没轮到，先停在这里
+                    lane.running = False
+                    lane.parked = True
+                    return
+                for other_key, other in task.lanes:
+                    other.pending.popleft()
+                    if other is not lane:
+                        # 执行完之前其他队列保持running，新命令只排队
+                        other.parked = False
+                        other.running = True
+                        restart.append((other_key, other))
+            self._run(task.command, task.future)
+            for other_key, other in restart:
+                self.pool.submit(self._drain, other_key, other)
+
+    def shutdown(self, wait=True):
+        self.pool.shutdown(wait=wait)
+
+
+# 命令对象适合做日志，但现在什么都没有保存，崩溃后接收者的状态都丢了
+# 解决：预写日志，命令执行前先追加紧凑的二进制记录并等待fsync，多个调用者的记录一起fsync(组提交)，启动时重放，定期压缩
+EXECUTE = 0
+UNDO = 1
+
+
+class CommandJournal(object):
+    """
+    记录格式：crc32(I) 长度(H) 命令类型id(H) 操作(B) | 名称长度(H) 接收者名称(utf-8) 参数(json)
+    crc覆盖头部其余部分和数据，重放时遇到不完整或校验失败的记录就截断
+    append等到包含自己记录的那次fsync完成才返回；攒够batch_size条或等待window秒后一起fsync
+    """
+    header = struct.Struct('<IHHB')
+    name_length = struct.Struct('<H')
+
+    def __init__(self, path, batch_size=64, window=0.01):
+        self.path = path
+        self.batch_size = batch_size
+        self.window = window
+        self.command_types = []
+        self.command_ids = {}
+        # 名称 <-> 接收者
+        self.receivers = {}
+        self.receiver_names = {}
+        self.condition = threading.Condition()
+        self.buffer = []
+        self.first_pending = None
+        # 已追加和已落盘的记录序号
+        self.appended = 0
+        self.durable = 0
+        self.force = False
+        self.error = None
+        self.closed = False
+        # 文件读写(刷盘、重放、压缩)互斥
+        self.io_lock = threading.Lock()
+        self.file = open(path, 'ab')
+        self.flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self.flusher.start()
+
+    def register_command(self, command_cls):
+        """命令类型的注册顺序就是类型id，重放时必须按相同顺序注册"""
+        if command_cls not in self.command_ids:
+            self.command_ids[command_cls] = len(self.command_types)
+            self.command_types.append(command_cls)
+
+    def register_receiver(self, name, receiver):
+        self.receivers[name] = receiver
+        self.receiver_names[id(receiver)] = name
+
+    def encode(self, command, action=EXECUTE):
+        if type(command) not in self.command_ids:
+            raise ValueError(f'{type(command).__name__} is not registered in the journal')
+        receiver_name = self.receiver_names.get(id(command.get_receiver()))
+        if receiver_name is None:
+            raise ValueError(f'receiver of {command} is not registered in the journal')
+        name = receiver_name.encode('utf-8')
+        args = command.journal_args()
+        data = self.name_length.pack(len(name)) + name
+        if args:
+            data += json.dumps(list(args), separators=(',', ':')).encode('utf-8')
+        if len(data) > 0xffff:
+            raise ValueError(f'journal record of {command} is too large')
+        body = self.header.pack(0, len(data), self.command_ids[type(command)], action)[4:] + data
+        return struct.pack('<I', zlib.crc32(body)) + body
+
+    def append(self, command, action=EXECUTE):
+        """在执行命令之前调用，返回时记录已经fsync；宏命令拆成子命令记录"""
+        if isinstance(command, MacroCommand):
+            commands = command.commands if action == EXECUTE else command.commands[::-1]
+            records = [self.encode(sub, action) for sub in commands]
+        else:
+            records = [self.encode(command, action)]
+        with self.condition:
+            if self.closed:
+                raise ValueError('journal is closed')
+            if not self.buffer:
+                self.first_pending = time.monotonic()
+            self.buffer.extend(records)
+            self.appended += len(records)
+            seq = self.appended
+            self.condition.notify_all()
+            self._wait_durable(seq)
+
+    def _wait_durable(self, seq):
+        """需要持有self.condition"""
+        while self.durable < seq:
+            if self.error is not None:
+                raise self.error
+            self.condition.wait()
+
+    def sync(self):
+        """立即fsync所有已追加的记录"""
+        with self.condition:
+            self.force = True
+            self.condition.notify_all()
+            self._wait_durable(self.appended)
+
+    def _flush_loop(self):
+        while True:
+            with self.condition:
+                # 空闲时一直等待，不会定期唤醒
+                while not self.buffer and not self.closed:
+                    self.condition.wait()
+                if not self.buffer:
+                    return
+                # 攒够一批、时间窗口到期或者有人要求立即刷盘
+                while len(self.buffer) < self.batch_size and not self.force and not self.closed:
+                    remaining = self.first_pending + self.window - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                records = self.buffer
+                seq = self.appended
+                self.buffer = []
+                self.first_pending = None
+                self.force = False
+            # 写盘时不持有condition，新的记录可以继续追加到下一批
+            try:
+                with self.io_lock:
+                    self.file.write(b''.join(records))
+                    self.file.flush()
+                    os.fsync(self.file.fileno())
+            except OSError as e:
+                with self.condition:
+                    self.error = e
+                    self.condition.notify_all()
+                return
+            with self.condition:
+                self.durable = seq
+                self.condition.notify_all()
+
+    def records(self):
+        """读出所有完整的记录(类型id, 操作, 接收者名称, 参数)和有效数据的长度"""
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        records = []
+        offset = 0
+        while offset + self.header.size <= len(data):
+            crc, length, type_id, action = self.header.unpack_from(data, offset)
+            start = offset + self.header.size
+            end = start + length
+            if end > len(data) or zlib.crc32(data[offset + 4:end]) != crc:
+                break
+            name_length, = self.name_length.unpack_from(data, start)
+            name_end = start + self.name_length.size + name_length
+            name = data[start + self.name_length.size:name_end].decode('utf-8')
+            args = json.loads(data[name_end:end]) if end > name_end else []
+            records.append((type_id, action, name, args))
+            offset = end
+        return records, offset
+
+    def _build(self, type_id, name, args):
+        return self.command_types[type_id].from_journal(self.receivers[name], *args)
+
+    def replay(self):
+        """启动时调用，按顺序重新执行日志中的命令，并截断末尾不完整的记录"""
+        self.sync()
+        with self.io_lock:
+            records, valid = self.records()
+            self.file.truncate(valid)
+        for type_id, action, name, args in records:
+            command = self._build(type_id, name, args)
+            if action == EXECUTE:
+                command.execute()
+            else:
+                command.undo()
+        return len(records)
+
+    def compact(self):
+        """
+        从后往前扫描，一条记录写入的每个状态组都已经被后面的记录覆盖时才丢弃，保留的记录维持原来的先后顺序
+        开关、音量这类命令的最终状态只取决于最后一次写入它的操作，压缩前后重放的结果相同
+        """
+        self.sync()
+        with self.io_lock:
+            records, _ = self.records()
+            # (接收者名称, 组)，组为None表示接收者的全部状态都被覆盖了
+            covered = set()
+            keep = []
+            for i in range(len(records) - 1, -1, -1):
+                type_id, action, name, args = records[i]
+                groups = self._build(type_id, name, args).journal_groups(action)
+                if (name, None) in covered or all((name, group) in covered for group in groups):
+                    continue
+                keep.append(i)
+                covered.update((name, group) for group in groups)
+            keep.reverse()
+            tmp_path = self.path + '.compact'
+            with open(tmp_path, 'wb') as f:
+                for i in keep:
+                    type_id, action, name, args = records[i]
+                    f.write(self.encode(self._build(type_id, name, args), action))
+                f.flush()
+                os.fsync(f.fileno())
+            self.file.close()
+            os.replace(tmp_path, self.path)
+            self.file = open(self.path, 'ab')
+        return len(records) - len(keep)
+
+    def close(self):
+        self.sync()
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.flusher.join()
+        with self.io_lock:
+            self.file.close()
+
+
+class JournaledRemoteControl(RemoteControl):
+    """先写日志再执行，执行和撤销的命令都写入日志"""
+
+    def __init__(self, journal, slot_count=2):
+        super(JournaledRemoteControl, self).__init__(slot_count)
+        self.journal = journal
+
+    def press_on(self, slot):
+        self._log(self.on_commands[slot], EXECUTE)
+        super(JournaledRemoteControl, self).press_on(slot)
+
+    def press_off(self, slot):
+        self._log(self.off_commands[slot], EXECUTE)
+        super(JournaledRemoteControl, self).press_off(slot)
+
+    def press_undo(self):
+        self._log(self.pre_command, UNDO)
+        super(JournaledRemoteControl, self).press_undo()
+
+    def _log(self, command, action):
+        if command is not None and not isinstance(command, NoCommand):
+            self.journal.append(command, action)
+
+
+# 遥控器只记录了上一个命令，只能撤销一次，也不能重做
+# 解决：固定容量的环形缓冲区保存历史，push/undo/redo都是O(1)，超过深度或内存上限时丢弃最老的记录
+def command_size(command):
+    """估算命令占用的内存：对象、属性以及属性引用的值，不计共享的接收者"""
+    receivers = {id(receiver) for receiver in command.get_receivers()}
+    size = sys.getsizeof(command)
+    state = getattr(command, '__dict__', None)
+    if not state:
+        return size
+    size += sys.getsizeof(state)
+    for value in state.values():
+        if id(value) in receivers:
+            continue
+        if isinstance(value, CommandMixin):
+            size += command_size(value)
+        elif isinstance(value, (list, tuple)):
+            size += sys.getsizeof(value)
+            for item in value:
+                size += command_size(item) if isinstance(item, CommandMixin) else sys.getsizeof(item)
+        else:
+            size += sys.getsizeof(value)
+    return size
+
+
+def snapshot_command(command):
+    """
+    复制一份命令保存到历史中，插槽里的命令对象会被反复执行，
+    像StereoVolumeCommand.pre_volume这样的执行状态不能共享
+    """
+    if isinstance(command, MacroCommand):
+        return MacroCommand([snapshot_command(sub) for sub in command.commands])
+    return copy.copy(command)
+
+
+class CommandHistory(object):
+    """
+    depth: 最多保存的命令数
+    max_bytes: 命令占用内存的上限(按size_of估算)，None不限制
+    命令实现了merge(other)并返回合并后的命令时，相邻的命令合并为一条
+    push时保存的是命令的副本，之后再次执行同一个命令对象不会影响历史
+    """
+
+    def __init__(self, depth=64, max_bytes=None, size_of=command_size):
+        if depth < 1:
+            raise ValueError(f'depth must be at least 1, got {depth}')
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.size_of = size_of
+        self.entries = [None] * depth
+        self.sizes = [0] * depth
+        # 最老记录的位置，记录总数(包括可重做的)，可撤销的数量
+        self.start = 0
+        self.count = 0
+        self.cursor = 0
+        self.bytes = 0
+
+    def _slot(self, i):
+        return (self.start + i) % self.depth
+
+    def _clear(self, i):
+        slot = self._slot(i)
+        self.entries[slot] = None
+        self.bytes -= self.sizes[slot]
+        self.sizes[slot] = 0
+
+    def _drop_oldest(self):
+        self._clear(0)
+        self.start = (self.start + 1) % self.depth
+        self.count -= 1
+        self.cursor -= 1
+
+    def push(self, command):
+        if isinstance(command, NoCommand):
+            return
+        command = snapshot_command(command)
+        # 新命令之后不能再重做
+        while self.count > self.cursor:
+            self.count -= 1
+            self._clear(self.count)
+        if self.cursor:
+            merge = getattr(self.entries[self._slot(self.cursor - 1)], 'merge', None)
+            merged = merge(command) if merge is not None else None
+            if merged is not None:
+                self.cursor -= 1
+                self.count -= 1
+                self._clear(self.cursor)
+                command = merged
+        if self.count == self.depth:
+            self._drop_oldest()
+        slot = self._slot(self.count)
+        self.entries[slot] = command
+        self.sizes[slot] = self.size_of(command)
+        self.bytes += self.sizes[slot]
+        self.count += 1
+        self.cursor += 1
+        while self.max_bytes is not None and self.bytes > self.max_bytes and self.count > 1:
+            self._drop_oldest()
+
+    def undo(self):
+        """返回需要撤销的命令，没有可撤销的返回None"""
+        if not self.cursor:
+            return None
+        self.cursor -= 1
+        return self.entries[self._slot(self.cursor)]
+
+    def redo(self):
+        """返回需要重做的命令，没有可重做的返回None"""
+        if self.cursor == self.count:
+            return None
+        command = self.entries[self._slot(self.cursor)]
+        self.cursor += 1
+        return command
+
+    def can_undo(self):
+        return self.cursor > 0
+
+    def can_redo(self):
+        return self.cursor < self.count
+
+
+class HistoryRemoteControl(RemoteControl):
+    """多级撤销和重做的遥控器"""
+
+    def __init__(self, slot_count=2, depth=64, max_bytes=None):
+        super(HistoryRemoteControl, self).__init__(slot_count)
+        self.history = CommandHistory(depth, max_bytes)
+
+    def press_on(self, slot):
+        super(HistoryRemoteControl, self).press_on(slot)
+        self.history.push(self.pre_command)
+
+    def press_off(self, slot):
+        super(HistoryRemoteControl, self).press_off(slot)
+        self.history.push(self.pre_command)
+
+    def press(self, command):
+        """直接执行一个命令，比如调音量"""
+        command.execute()
+        self.pre_command = command
+        self.history.push(command)
+
+    def press_undo(self):
+        print('press undo..')
+        command = self.history.undo()
+        if command is not None:
+            command.undo()
+
+    def press_redo(self):
+        print('press redo..')
+        command = self.history.redo()
+        if command is not None:
+            command.execute()
+
 
 @start_end
 def simple_main():
@@ -261,8 +861,79 @@ def macro_main():
     control.press_undo()
 
 
+@start_end
+def executor_main():
+    light = Light()
+    stereo = Stereo()
+    executor = CommandExecutor(max_workers=4)
+    futures = [executor.submit(command) for command in (
+        LightOnCommand(light), StereoOnCommand(stereo), LightOffCommand(light), StereoOffCommand(stereo))]
+    for future in futures:
+        future.result()
+    executor.shutdown()
+
+
+@start_end
+def journal_main():
+    import tempfile
+    path = os.path.join(tempfile.mkdtemp(), 'commands.journal')
+    light = Light()
+    stereo = Stereo()
+
+    def open_journal():
+        journal = CommandJournal(path)
+        for command_cls in (LightOnCommand, LightOffCommand, StereoOnCommand, StereoOffCommand,
+                            StereoVolumeCommand):
+            journal.register_command(command_cls)
+        journal.register_receiver('light', light)
+        journal.register_receiver('stereo', stereo)
+        return journal
+
+    journal = open_journal()
+    control = JournaledRemoteControl(journal)
+    control.set_command(0, LightOnCommand(light), LightOffCommand(light))
+    control.set_command(1, StereoOnCommand(stereo), StereoVolumeCommand(stereo, 20))
+    control.press_on(0)
+    control.press_on(1)
+    control.press_off(1)
+    control.press_off(0)
+    control.press_undo()
+    journal.close()
+
+    # 重启后重放
+    journal = open_journal()
+    print('compacted %s records' % journal.compact())
+    print('replay %s records' % journal.replay())
+    journal.close()
+    os.remove(path)
+
+
+@start_end
+def history_main():
+    light = Light()
+    stereo = Stereo()
+    control = HistoryRemoteControl(depth=3)
+    control.set_command(0, LightOnCommand(light), LightOffCommand(light))
+    control.set_command(1, StereoOnCommand(stereo), StereoOffCommand(stereo))
+    control.press_on(0)
+    control.press_on(1)
+    # 连续调音量合并成一条历史
+    control.press(StereoVolumeCommand(stereo, 15))
+    control.press(StereoVolumeCommand(stereo, 20))
+    control.press_undo()
+    control.press_undo()
+    control.press_redo()
+    control.press_off(0)
+    control.press_undo()
+    control.press_undo()
+    control.press_undo()
+
+
 if __name__ == '__main__':
     simple_main()
     remote_main()
     remote_with_undo_main()
     macro_main()
+    executor_main()
+    journal_main()
+    history_main()
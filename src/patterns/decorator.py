@@ -13,9 +13,18 @@
     对为茶饮添加各种配料(套娃)
     beverage 饮料 grass jelly 仙草冻 2.00 coffee jelly 咖啡冻 3.00 coconut jelly 椰果 3.50 pudding 布丁 3.00
 """
+import array
+import json
+import threading
+import types
 
 from src.utils import start_end
 
+try:
+    import numpy as np
+except ImportError:  # 没有numpy时退化为纯python计算
+    np = None
+
 
 class StartBeverage(object):
     description = 'unknown'
@@ -161,21 +170,52 @@ class MidBubbleTea(MidBeverage):
 # 怎么这么多条件判断，而且我要双份椰果怎么办?
 # 解决2，使用装饰者模式
 
+class CatalogPrice(object):
+    """
+    价格描述符：类和实例上读取price时都去查当前的价目表快照(见下方PriceCatalog)
+    价目表里没有这一项时使用默认价格
+    """
+
+    def __init__(self, key, default):
+        self.key = key
+        self.default = default
+
+    def __get__(self, obj, owner=None):
+        return self.lookup(catalog.snapshot)
+
+    def lookup(self, snapshot):
+        return snapshot.prices.get(self.key, self.default)
+
+
+def catalog_price(cls, snapshot):
+    """cls在指定快照中的价格，price不是CatalogPrice时直接返回"""
+    for klass in cls.__mro__:
+        if 'price' in vars(klass):
+            price = vars(klass)['price']
+            return price.lookup(snapshot) if isinstance(price, CatalogPrice) else price
+    raise AttributeError(f'{cls.__name__} has no price')
+
+
 class BubbleTea(StartBeverage):
     description = 'bubble tea'
+    price = CatalogPrice('bubble tea', 15.00)
 
-    def cost(self):
-        return 15.00
+    def cost(self, snapshot=None):
+        return catalog_price(type(self), snapshot or catalog.snapshot)
 
 
 class FruitTea(StartBeverage):
     description = 'bubble tea'
+    price = CatalogPrice('fruit tea', 15.00)
 
-    def cost(self):
-        return 15.00
+    def cost(self, snapshot=None):
+        return catalog_price(type(self), snapshot or catalog.snapshot)
 
 
 class CondimentDecorator(StartBeverage):
+    # 子类用name和price声明配料名称和单价，flatten等不递归的计算按这两个属性进行
+    # cost(snapshot)把最外层读到的价目表快照传给里层，整条装饰链按同一个快照计价
+
     def get_description(self):
         """需要重写这个方法"""
         raise NotImplementedError
@@ -186,51 +226,428 @@ class CondimentDecorator(StartBeverage):
 
 
 class Grass(CondimentDecorator):
+    name = 'grass'
+    price = CatalogPrice('grass', 2.00)
 
     def __init__(self, beverage):
         self.beverage = beverage
 
     def get_description(self):
-        return self.beverage.get_description() + ', grass'
+        return self.beverage.get_description() + ', ' + self.name
 
-    def cost(self):
-        return self.beverage.cost() + 2.00
+    def cost(self, snapshot=None):
+        snapshot = snapshot or catalog.snapshot
+        return self.beverage.cost(snapshot) + catalog_price(type(self), snapshot)
 
 
 class Coffee(CondimentDecorator):
+    name = 'coffee'
+    price = CatalogPrice('coffee', 3.00)
 
     def __init__(self, beverage):
         self.beverage = beverage
 
     def get_description(self):
-        return self.beverage.get_description() + ', coffee'
+        return self.beverage.get_description() + ', ' + self.name
 
-    def cost(self):
-        return self.beverage.cost() + 3.00
+    def cost(self, snapshot=None):
+        snapshot = snapshot or catalog.snapshot
+        return self.beverage.cost(snapshot) + catalog_price(type(self), snapshot)
 
 
 class Coconut(CondimentDecorator):
+    name = 'coconut'
+    price = CatalogPrice('coconut', 3.50)
 
     def __init__(self, beverage):
         self.beverage = beverage
 
     def get_description(self):
-        return self.beverage.get_description() + ', coconut'
+        return self.beverage.get_description() + ', ' + self.name
 
-    def cost(self):
-        return self.beverage.cost() + 3.50
+    def cost(self, snapshot=None):
+        snapshot = snapshot or catalog.snapshot
+        return self.beverage.cost(snapshot) + catalog_price(type(self), snapshot)
 
 
 class Pudding(CondimentDecorator):
+    name = 'pudding'
+    price = CatalogPrice('pudding', 3.00)
 
     def __init__(self, beverage):
         self.beverage = beverage
 
     def get_description(self):
-        return self.beverage.get_description() + ', pudding'
+        return self.beverage.get_description() + ', ' + self.name
+
+    def cost(self, snapshot=None):
+        snapshot = snapshot or catalog.snapshot
+        return self.beverage.cost(snapshot) + catalog_price(type(self), snapshot)
+
+
+# 每层装饰者cost和get_description都递归一次，大约1000层就超过递归深度
+# 解决：把装饰链编译成一个扁平对象，预先算好总价和描述，并统计每种配料的数量
+class FlatBeverage(StartBeverage):
+    """
+    编译后的饮料，get_description是O(1)且不递归
+    价目表没变时cost直接返回编译时算好的总价，替换后按配料数量重新计价
+    它本身也是饮料，编译后还可以继续用装饰者包装，再次编译时会合并
+    """
+
+    def __init__(self, base, condiments, cost, description, snapshot):
+        self.base = base
+        # 配料类 -> 数量，按第一次加入的顺序
+        self.condiments = condiments
+        self._cost = cost
+        self.description = description
+        # 计算_cost用的价目表快照
+        self.snapshot = snapshot
+
+    def cost(self, snapshot=None):
+        snapshot = snapshot or catalog.snapshot
+        if snapshot is self.snapshot:
+            return self._cost
+        total = self.base.cost(snapshot)
+        for condiment, n in self.condiments.items():
+            total += catalog_price(condiment, snapshot) * n
+        return total
+
+    def count(self, condiment):
+        return self.condiments.get(condiment, 0)
+
+
+def unwrap(beverage, required=('name', 'price')):
+    """
+    非递归地拆开装饰链，返回(最里层饮料, 从里到外的配料类列表)
+    配料没有声明required中的属性时，无法不调用cost和get_description计算，抛出TypeError
+    """
+    layers = []
+    while isinstance(beverage, CondimentDecorator):
+        condiment = type(beverage)
+        if not all(hasattr(condiment, attr) for attr in required):
+            raise TypeError(f'{condiment.__name__} must declare {" and ".join(required)} to be unwrapped')
+        layers.append(condiment)
+        beverage = beverage.beverage
+    layers.reverse()
+    return beverage, layers
+
+
+def flatten(beverage):
+    """编译装饰链，结果与原装饰链的cost和get_description相同"""
+    base, layers = unwrap(beverage)
+    snapshot = catalog.snapshot
+    if isinstance(base, FlatBeverage):
+        # 编译后又加的装饰者，在已编译的结果上继续累加
+        condiments = dict(base.condiments)
+        cost = base.cost(snapshot)
+        parts = [base.get_description()]
+        base = base.base
+    else:
+        condiments = {}
+        cost = base.cost(snapshot)
+        parts = [base.get_description()]
+    for condiment in layers:
+        condiments[condiment] = condiments.get(condiment, 0) + 1
+        # 按装饰链相同的顺序累加，保证浮点数结果一致
+        cost = cost + catalog_price(condiment, snapshot)
+        parts.append(condiment.name)
+    return FlatBeverage(base, condiments, cost, ', '.join(parts), snapshot)
+
+
+# get_description每层都拼接一次字符串，N层装饰链要复制O(N^2)个字符
+# 解决：遍历一次装饰链收集配料名称，最后只join一次，重复的配料合并成"coconut x2"
+def describe(beverage, group=True):
+    """
+    group=False时与get_description的结果相同
+    只用到配料的name，没有声明name的配料抛出TypeError
+    """
+    base, layers = unwrap(beverage, required=('name',))
+    if not group:
+        # 已编译的饮料描述是预先算好的，直接复用
+        return ', '.join([base.get_description()] + [condiment.name for condiment in layers])
+    counts = {}
+    if isinstance(base, FlatBeverage):
+        counts.update((condiment.name, n) for condiment, n in base.condiments.items())
+        base = base.base
+    for condiment in layers:
+        counts[condiment.name] = counts.get(condiment.name, 0) + 1
+    parts = [base.get_description()]
+    for name, n in counts.items():
+        parts.append(name if n == 1 else '%s x%s' % (name, n))
+    return ', '.join(parts)
+
+
+# 批量计价时每个订单都要构造一串装饰者对象再调用cost
+# 解决：订单表示成数量矩阵(每列是一种饮料或配料)，和价格向量做一次矩阵乘法
+class BatchPricer(object):
+    def __init__(self):
+        # 列顺序：先饮料后配料
+        self.columns = []
+        self.index = {}
+        self._vector = None
+        self._snapshot = None
+
+    def register_beverage(self, beverage_cls):
+        return self._register(beverage_cls)
+
+    def register_condiment(self, condiment_cls):
+        return self._register(condiment_cls)
+
+    def _register(self, cls):
+        if cls not in self.index:
+            self.index[cls] = len(self.columns)
+            self.columns.append(cls)
+            self._vector = None
+        return self.index[cls]
+
+    @property
+    def vector(self):
+        # 价目表替换后重新生成价格向量
+        snapshot = catalog.snapshot
+        if self._vector is None or self._snapshot is not snapshot:
+            prices = [catalog_price(cls, snapshot) for cls in self.columns]
+            self._vector = np.array(prices, dtype=float) if np is not None else prices
+            self._snapshot = snapshot
+        return self._vector
+
+    def encode(self, beverage):
+        """把装饰链(或编译后的饮料)转换成矩阵的一行"""
+        base, layers = unwrap(beverage)
+        row = [0] * len(self.columns)
+        if isinstance(base, FlatBeverage):
+            for condiment, count in base.condiments.items():
+                row[self.index[condiment]] += count
+            base = base.base
+        row[self.index[type(base)]] += 1
+        for condiment in layers:
+            row[self.index[condiment]] += 1
+        return row
+
+    def price(self, orders):
+        """
+        orders为二维数量矩阵(list或numpy数组)，每行的长度必须等于列数
+        有没有numpy都返回每个订单价格的list
+        """
+        if len(orders) == 0:
+            return []
+        columns = len(self.columns)
+        if np is not None:
+            try:
+                matrix = np.asarray(orders, dtype=float)
+            except ValueError:
+                matrix = None
+            if matrix is not None and matrix.ndim == 2 and matrix.shape[1] == columns:
+                return (matrix @ self.vector).tolist()
+        for i, row in enumerate(orders):
+            if len(row) != columns:
+                raise ValueError(f'order {i} has {len(row)} counts, expected {columns}')
+        vector = self.vector
+        return [sum(count * price for count, price in zip(row, vector)) for row in orders]
+
+    def price_beverages(self, beverages):
+        return self.price([self.encode(beverage) for beverage in beverages])
+
+
+def default_pricer():
+    pricer = BatchPricer()
+    for beverage_cls in (BubbleTea, FruitTea):
+        pricer.register_beverage(beverage_cls)
+    for condiment_cls in (Grass, Coffee, Coconut, Pudding):
+        pricer.register_condiment(condiment_cls)
+    return pricer
+
+
+# MidBeverage每种配料一个布尔属性，表达不了双份椰果；装饰链可以，但每份配料都是一个对象
+# 解决：__slots__的紧凑饮料，配料数量保存在按配料id索引的定长数组里，可哈希用于去重
+CONDIMENTS = (Grass, Coffee, Coconut, Pudding)
+CONDIMENT_IDS = {condiment: i for i, condiment in enumerate(CONDIMENTS)}
+
+
+class CompactBeverage(object):
+    """
+    不继承StartBeverage，否则会有__dict__，和饮料一样提供cost和get_description
+    counts是每种配料4字节的不可变bytes，每种配料最多4294967295份
+    """
+    __slots__ = ('base', 'counts')
+    count_type = 'I'
+    count_size = array.array(count_type).itemsize
+
+    def __init__(self, base, counts=None):
+        self.base = base
+        if counts is None:
+            counts = self.empty_counts().tobytes()
+        elif not isinstance(counts, bytes):
+            counts = array.array(self.count_type, counts).tobytes()
+        if len(counts) != self.count_size * len(CONDIMENTS):
+            raise ValueError(f'expected counts for {len(CONDIMENTS)} condiments, got {len(counts)} bytes')
+        self.counts = counts
+
+    @classmethod
+    def empty_counts(cls):
+        return array.array(cls.count_type, bytes(cls.count_size * len(CONDIMENTS)))
+
+    def _counts(self):
+        return memoryview(self.counts).cast(self.count_type)
+
+    def count(self, condiment):
+        return self._counts()[CONDIMENT_IDS[condiment]]
+
+    def add(self, condiment, n=1):
+        """不可变对象，返回新的饮料；n为负数时减少配料，减到0以下抛出ValueError"""
+        counts = array.array(self.count_type, self.counts)
+        i = CONDIMENT_IDS[condiment]
+        if counts[i] + n < 0:
+            raise ValueError(f'cannot remove {-n} {condiment.name}, only {counts[i]} added')
+        try:
+            counts[i] += n
+        except OverflowError:
+            raise OverflowError(f'too many {condiment.name}') from None
+        return CompactBeverage(self.base, counts.tobytes())
+
+    def cost(self, snapshot=None):
+        # 读类属性的价格，不为计价创建饮料对象；整个计价过程只读取一次快照
+        snapshot = snapshot or catalog.snapshot
+        total = catalog_price(self.base, snapshot)
+        for condiment, n in zip(CONDIMENTS, self._counts()):
+            total += catalog_price(condiment, snapshot) * n
+        return total
 
-    def cost(self):
-        return self.beverage.cost() + 3.00
+    def get_description(self):
+        parts = [self.base.description]
+        for condiment, n in zip(CONDIMENTS, self._counts()):
+            parts.extend([condiment.name] * n)
+        return ', '.join(parts)
+
+    @classmethod
+    def from_chain(cls, beverage):
+        base, layers = unwrap(beverage)
+        counts = cls.empty_counts()
+        if isinstance(base, FlatBeverage):
+            for condiment, n in base.condiments.items():
+                counts[CONDIMENT_IDS[condiment]] += n
+            base = base.base
+        for condiment in layers:
+            counts[CONDIMENT_IDS[condiment]] += 1
+        return cls(type(base), counts.tobytes())
+
+    def to_chain(self):
+        """配料按id顺序包装，原装饰链的顺序不保留"""
+        beverage = self.base()
+        for condiment, n in zip(CONDIMENTS, self._counts()):
+            for _ in range(n):
+                beverage = condiment(beverage)
+        return beverage
+
+    def __eq__(self, other):
+        if not isinstance(other, CompactBeverage):
+            return NotImplemented
+        return self.base is other.base and self.counts == other.counts
+
+    def __hash__(self):
+        return hash((self.base, self.counts))
+
+    def __repr__(self):
+        return 'CompactBeverage(%s)' % self.get_description()
+
+
+# 价格写死在代码里，改价格要重新部署，每份配料还都是一个新的包装对象
+# 解决：配料是共享的享元对象，价格放在不可变的价目表快照里，整体原子替换
+# 装饰者、FlatBeverage、CompactBeverage和BatchPricer也按同一份价目表计价，每次计价只读取一次快照
+class Condiment(object):
+    """配料享元，同名配料全局只有一个对象"""
+    __slots__ = ('name',)
+    _interned = {}
+    _lock = threading.Lock()
+
+    def __new__(cls, name):
+        condiment = cls._interned.get(name)
+        if condiment is None:
+            with cls._lock:
+                condiment = cls._interned.get(name)
+                if condiment is None:
+                    condiment = object.__new__(cls)
+                    condiment.name = name
+                    cls._interned[name] = condiment
+        return condiment
+
+    def __repr__(self):
+        return 'Condiment(%r)' % self.name
+
+
+class PriceSnapshot(object):
+    """不可变价目表，名称 -> 价格"""
+    __slots__ = ('version', 'prices')
+
+    def __init__(self, version, prices):
+        self.version = version
+        self.prices = types.MappingProxyType(dict(prices))
+
+    def price(self, name):
+        return self.prices[name]
+
+
+class PriceCatalog(object):
+    """
+    读：snapshot = catalog.snapshot，之后一直用这个快照，不加锁
+    写：构造新快照后一次属性赋值替换，读者要么看到旧的要么看到新的
+    """
+
+    def __init__(self, prices=None):
+        self._write_lock = threading.Lock()
+        self.snapshot = PriceSnapshot(0, prices or {})
+
+    def load(self, prices):
+        with self._write_lock:
+            self.snapshot = PriceSnapshot(self.snapshot.version + 1, prices)
+        return self.snapshot
+
+    def update(self, **prices):
+        """在当前价格基础上修改部分价格"""
+        with self._write_lock:
+            merged = dict(self.snapshot.prices)
+            merged.update(prices)
+            self.snapshot = PriceSnapshot(self.snapshot.version + 1, merged)
+        return self.snapshot
+
+    def load_file(self, path):
+        """从json文件热加载：{"bubble tea": 15.0, "grass": 2.0, ...}"""
+        with open(path) as f:
+            return self.load(json.load(f))
+
+
+def default_catalog():
+    """默认价格来自各个类上的CatalogPrice"""
+    prices = {}
+    for cls in (BubbleTea, FruitTea) + CONDIMENTS:
+        price = cls.__dict__['price']
+        prices[price.key] = price.default
+    return PriceCatalog(prices)
+
+
+catalog = default_catalog()
+
+
+class CatalogBeverage(object):
+    """饮料只保存配料享元的引用，计价时查当前的价目表快照"""
+    __slots__ = ('base', 'condiments')
+
+    def __init__(self, base, condiments=()):
+        self.base = base
+        self.condiments = tuple(Condiment(name) if isinstance(name, str) else name for name in condiments)
+
+    def add(self, name):
+        return CatalogBeverage(self.base, self.condiments + (Condiment(name),))
+
+    def cost(self, snapshot=None):
+        # 整个计价过程只读取一次快照，中途替换价目表不会算出新旧混合的价格
+        prices = (snapshot or catalog.snapshot).prices
+        total = prices[self.base]
+        for condiment in self.condiments:
+            total += prices[condiment.name]
+        return total
+
+    def get_description(self):
+        return ', '.join((self.base,) + tuple(condiment.name for condiment in self.condiments))
 
 
 @start_end
@@ -252,6 +669,61 @@ def end_main():
     print('%s ￥%s' % (beverage.get_description(), beverage.cost()))
 
 
+@start_end
+def flatten_main():
+    beverage = BubbleTea()
+    for i in range(1000):
+        beverage = Coconut(beverage)
+    # beverage.cost()会超过递归深度
+    flat = flatten(beverage)
+    print('%s... ￥%s' % (flat.get_description()[:30], flat.cost()))
+    flat = flatten(Grass(flat))
+    print(flat.count(Coconut), flat.count(Grass), flat.cost())
+
+
+@start_end
+def batch_pricing_main():
+    pricer = default_pricer()
+    # 列：bubble tea, fruit tea, grass, coffee, coconut, pudding
+    orders = [
+        [1, 0, 1, 0, 2, 0],
+        [0, 1, 0, 1, 0, 1],
+    ]
+    print(pricer.price(orders))
+    print(pricer.price_beverages([Coconut(Coconut(Grass(BubbleTea())))]))
+
+
+@start_end
+def compact_main():
+    beverage = CompactBeverage(BubbleTea).add(Grass).add(Coconut, 2)
+    same = CompactBeverage.from_chain(Coconut(Grass(Coconut(BubbleTea()))))
+    print(beverage, beverage.cost(), beverage == same, len({beverage, same}))
+    chain = beverage.to_chain()
+    print('%s ￥%s' % (chain.get_description(), chain.cost()))
+
+
+@start_end
+def catalog_main():
+    beverage = CatalogBeverage('bubble tea').add('grass').add('coconut').add('coconut')
+    print(beverage.condiments[1] is beverage.condiments[2])
+    print('%s ￥%s' % (beverage.get_description(), beverage.cost()))
+    # 热更新价格，不用重新部署
+    catalog.update(coconut=4.00)
+    print('%s ￥%s' % (beverage.get_description(), beverage.cost()))
+
+
+@start_end
+def describe_main():
+    beverage = Coconut(Grass(Coconut(BubbleTea())))
+    print(describe(beverage, group=False))
+    print(describe(beverage))
+
+
 if __name__ == '__main__':
     mid_main()
     end_main()
+    flatten_main()
+    batch_pricing_main()
+    compact_main()
+    catalog_main()
+    describe_main()
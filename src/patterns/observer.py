@@ -18,8 +18,29 @@
     2.针对接口而不是实现：主题和观察者都使用了接口
     3.多用组合：多个观察者组合进主题中而不是继承
 """
+import array
+import asyncio
+import collections
+import csv
+import itertools
+import math
+import mmap
+import multiprocessing
+import operator
+import queue
+import struct
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
 from src.utils import start_end
 
+try:
+    import numpy as np
+except ImportError:  # 没有numpy时退化为内置函数计算
+    np = None
+
 
 class StartWeatherData(object):
     """
@@ -85,6 +106,304 @@ class StartForecast(object):
         return 'Forecast'
 
 
+# 统计公告板需要历史数据，用list保存会无限增长
+# 解决：固定容量的环形缓冲区保存最近的读数，累计统计量O(1)更新
+class RunningStats(object):
+    """Welford算法，O(1)更新最小/最大/均值/方差"""
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def push(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    @property
+    def variance(self):
+        return self.m2 / self.count if self.count else 0.0
+
+    def snapshot(self):
+        return {'count': self.count, 'min': self.min, 'max': self.max,
+                'mean': self.mean, 'variance': self.variance}
+
+
+class MeasurementRing(object):
+    """基于array的环形缓冲区，内存占用固定为capacity个(temperature, humidity, pressure)"""
+    fields = ('temperature', 'humidity', 'pressure')
+
+    def __init__(self, capacity=1024):
+        if capacity < 1:
+            raise ValueError(f'capacity must be at least 1, got {capacity}')
+        self.capacity = capacity
+        self.columns = {field: array.array('d', bytes(8 * capacity)) for field in self.fields}
+        self.stats = {field: RunningStats() for field in self.fields}
+        # 下一个写入位置以及已写入数量
+        self.index = 0
+        self.size = 0
+
+    def push(self, temperature, humidity, pressure):
+        for field, value in zip(self.fields, (temperature, humidity, pressure)):
+            self.columns[field][self.index] = value
+            self.stats[field].push(value)
+        self.index = (self.index + 1) % self.capacity
+        if self.size < self.capacity:
+            self.size += 1
+
+    def __len__(self):
+        return self.size
+
+    def window(self, field, n=None):
+        """最近n个读数(按时间顺序)，切片在C层完成"""
+        n = self.size if n is None else min(n, self.size)
+        column = self.columns[field]
+        start = self.index - n
+        if start >= 0:
+            return column[start:self.index]
+        return column[start + self.capacity:] + column[:self.index]
+
+    def rolling(self, field, n=None):
+        """最近n个读数的聚合，有numpy时向量化计算，否则用C实现的内置函数"""
+        values = self.window(field, n)
+        if not values:
+            return {'count': 0}
+        count = len(values)
+        if np is not None:
+            data = np.frombuffer(values, dtype=float)
+            return {'count': count, 'min': float(data.min()), 'max': float(data.max()),
+                    'mean': float(data.mean()), 'variance': float(data.var())}
+        mean = math.fsum(values) / count
+        # E[x^2] - mean^2，fsum精确求和减少误差
+        variance = max(math.fsum(map(operator.mul, values, values)) / count - mean * mean, 0.0)
+        return {'count': count, 'min': min(values), 'max': max(values),
+                'mean': mean, 'variance': variance}
+
+
+class RingStatistics(object):
+    """带历史的统计公告板"""
+
+    def __init__(self, capacity=1024, window=None):
+        self.ring = MeasurementRing(capacity)
+        self.window = window
+
+    def update(self, temperature, humidity, pressure):
+        self.ring.push(temperature, humidity, pressure)
+        stats = self.ring.stats['temperature']
+        print(f'Statistics: temperature avg/max/min:{stats.mean:.2f}/{stats.max}/{stats.min}')
+
+    def update_many(self, batch):
+        for temperature, humidity, pressure in batch:
+            self.ring.push(temperature, humidity, pressure)
+        stats = self.ring.stats['temperature']
+        print(f'Statistics: {len(batch)} readings, temperature avg/max/min:{stats.mean:.2f}/{stats.max}/{stats.min}')
+
+    def rolling(self, field):
+        return self.ring.rolling(field, self.window)
+
+    def __str__(self):
+        return 'RingStatistics'
+
+
+# notify_observers变慢时不知道是哪个观察者的问题
+# 解决：可选的耗时统计，按对数分桶的直方图记录每个观察者update的耗时，以及调用和异常次数
+class LatencyHistogram(object):
+    """第i个桶统计耗时(纳秒)的二进制位数为i的次数，即[2^(i-1), 2^i)"""
+    bucket_count = 64
+
+    def __init__(self):
+        self.buckets = [0] * self.bucket_count
+        self.count = 0
+        self.total_ns = 0
+
+    def record(self, ns):
+        self.buckets[min(ns.bit_length(), self.bucket_count - 1)] += 1
+        self.count += 1
+        self.total_ns += ns
+
+    def quantile(self, q):
+        """返回分位数所在桶的上界(纳秒)"""
+        if not self.count:
+            return 0
+        target = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= target:
+                return 1 << i
+        return 1 << (self.bucket_count - 1)
+
+    def snapshot(self):
+        return {'count': self.count,
+                'mean_ns': self.total_ns // self.count if self.count else 0,
+                'p50_ns': self.quantile(0.5),
+                'p99_ns': self.quantile(0.99),
+                'buckets': {1 << i: n for i, n in enumerate(self.buckets) if n}}
+
+
+class DispatchInstrumentation(object):
+    """
+    snapshot以"名称@id"为key，同类的多个观察者分别统计
+    update和update_many各算一次调用
+    """
+
+    def __init__(self):
+        # id(observer) -> [名称, 调用次数, 异常次数, 直方图]
+        self.stats = {}
+        self.lock = threading.Lock()
+        self.dump_timer = None
+
+    def call(self, observer, temperature, humidity, pressure):
+        start = time.perf_counter_ns()
+        error = False
+        try:
+            observer.update(temperature, humidity, pressure)
+        except Exception:
+            error = True
+            raise
+        finally:
+            self.record(observer, time.perf_counter_ns() - start, error)
+
+    def call_many(self, observer, batch):
+        start = time.perf_counter_ns()
+        error = False
+        try:
+            observer.update_many(batch)
+        except Exception:
+            error = True
+            raise
+        finally:
+            self.record(observer, time.perf_counter_ns() - start, error)
+
+    def record(self, observer, elapsed, error=False):
+        with self.lock:
+            stat = self.stats.get(id(observer))
+            if stat is None:
+                stat = self.stats[id(observer)] = ['%s@%x' % (observer, id(observer)), 0, 0, LatencyHistogram()]
+            stat[1] += 1
+            stat[2] += error
+            stat[3].record(elapsed)
+
+    def snapshot(self):
+        with self.lock:
+            return {name: dict(calls=calls, errors=errors, latency=histogram.snapshot())
+                    for name, calls, errors, histogram in self.stats.values()}
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+
+    def start_periodic_dump(self, interval, callback=print):
+        """每interval秒把snapshot交给callback，重复调用会替换之前的定时任务"""
+
+        def dump():
+            # 已经stop或者被新的定时任务替换时不再继续
+            if self.dump_timer is not threading.current_thread():
+                return
+            callback(self.snapshot())
+            # callback执行期间可能被stop或替换，检查和重新定时在同一把锁内完成
+            with self.lock:
+                if self.dump_timer is threading.current_thread():
+                    arm()
+
+        def arm():
+            """需要持有self.lock"""
+            self.dump_timer = threading.Timer(interval, dump)
+            self.dump_timer.daemon = True
+            self.dump_timer.start()
+
+        with self.lock:
+            if self.dump_timer is not None:
+                self.dump_timer.cancel()
+            arm()
+
+    def stop_periodic_dump(self):
+        with self.lock:
+            if self.dump_timer is not None:
+                self.dump_timer.cancel()
+                self.dump_timer = None
+
+
+# 预报公告板只是打印，真正的预报每次都基于全部历史重新计算，越跑越慢
+# 解决：Holt双指数平滑，只保存水平和趋势，每次读数O(1)更新，状态可以保存和恢复
+class HoltSmoother(object):
+    def __init__(self, alpha=0.5, beta=0.3):
+        self.alpha = alpha
+        self.beta = beta
+        self.level = None
+        self.trend = 0.0
+        self.count = 0
+
+    def push(self, value):
+        if self.level is None:
+            self.level = value
+        else:
+            last_level = self.level
+            self.level = self.alpha * value + (1 - self.alpha) * (last_level + self.trend)
+            self.trend = self.beta * (self.level - last_level) + (1 - self.beta) * self.trend
+        self.count += 1
+
+    def forecast(self, steps=1):
+        if self.level is None:
+            return None
+        return self.level + steps * self.trend
+
+    def get_state(self):
+        return {'alpha': self.alpha, 'beta': self.beta, 'level': self.level,
+                'trend': self.trend, 'count': self.count}
+
+    def set_state(self, state):
+        self.alpha = state['alpha']
+        self.beta = state['beta']
+        self.level = state['level']
+        self.trend = state['trend']
+        self.count = state['count']
+
+
+class IncrementalForecast(object):
+    """根据气压趋势预报，气压上升天气转好，下降可能有雨"""
+    fields = ('temperature', 'humidity', 'pressure')
+
+    def __init__(self, alpha=0.5, beta=0.3, tolerance=0.1):
+        self.smoothers = {field: HoltSmoother(alpha, beta) for field in self.fields}
+        # 趋势在tolerance以内视为不变
+        self.tolerance = tolerance
+
+    def update(self, temperature, humidity, pressure):
+        for field, value in zip(self.fields, (temperature, humidity, pressure)):
+            self.smoothers[field].push(value)
+        print(f'Forecast: {self.outlook()}, next temperature:{self.smoothers["temperature"].forecast():.2f}')
+
+    def outlook(self):
+        trend = self.smoothers['pressure'].trend
+        if trend > self.tolerance:
+            return 'improving weather on the way'
+        if trend < -self.tolerance:
+            return 'watch out for cooler, rainy weather'
+        return 'more of the same'
+
+    def forecast(self, field, steps=1):
+        return self.smoothers[field].forecast(steps)
+
+    def checkpoint(self):
+        return {field: smoother.get_state() for field, smoother in self.smoothers.items()}
+
+    def restore(self, state):
+        for field, smoother in self.smoothers.items():
+            smoother.set_state(state[field])
+
+    def __str__(self):
+        return 'IncrementalForecast'
+
+
 # 这次不采用abc模块
 class SubjectMixin(object):
     def add_observer(self, observer):
@@ -105,6 +424,8 @@ class EndWeatherData(SubjectMixin):
         self.temperature = None
         self.humidity = None
         self.pressure = None
+        # 耗时统计，None时不统计
+        self.instrumentation = None
 
     def add_observer(self, observer):
         self.observers.append(observer)
@@ -119,12 +440,23 @@ class EndWeatherData(SubjectMixin):
             temperature = self.get_temperature()
             humidity = self.get_humidity()
             pressure = self.get_pressure()
+            instrumentation = self.instrumentation
             for observer in self.observers:
                 # 观察者都实现了update接口，并且采取了被push方式
                 # 如果采取pull方式，则将被观察者对象传过去，让观察者调用其getter方法
-                observer.update(temperature, humidity, pressure)
+                if instrumentation is None:
+                    observer.update(temperature, humidity, pressure)
+                else:
+                    instrumentation.call(observer, temperature, humidity, pressure)
             self.changed = False
 
+    def enable_instrumentation(self, instrumentation=None):
+        self.instrumentation = instrumentation or DispatchInstrumentation()
+        return self.instrumentation
+
+    def disable_instrumentation(self):
+        self.instrumentation = None
+
     def measure_changed(self):
         self.notify_observers()
 
@@ -144,6 +476,609 @@ class EndWeatherData(SubjectMixin):
         self.changed = True
         self.measure_changed()
 
+    def set_changed_many(self, readings, batch_size=1024):
+        """
+        批量导入(temperature, humidity, pressure)，readings可以是任意可迭代对象
+        实现了update_many(batch)的观察者按批接收，其余观察者逐条update
+        不经过notify_observers，改变了分发方式的子类(过滤、线程池)需要覆盖这个方法
+        """
+        readings = iter(readings)
+        while True:
+            batch = list(itertools.islice(readings, batch_size))
+            if not batch:
+                break
+            self.temperature, self.humidity, self.pressure = batch[-1]
+            for observer in list(self.observers):
+                self.deliver_batch(observer, batch)
+        self.changed = False
+
+    def deliver_batch(self, observer, batch):
+        instrumentation = self.instrumentation
+        if getattr(observer, 'update_many', None) is not None:
+            if instrumentation is None:
+                observer.update_many(batch)
+            else:
+                instrumentation.call_many(observer, batch)
+        elif instrumentation is None:
+            for reading in batch:
+                observer.update(*reading)
+        else:
+            for reading in batch:
+                instrumentation.call(observer, *reading)
+
+
+# 批量导入的数据源
+PACKED_READING = struct.Struct('<3d')
+
+
+def iter_csv_readings(path):
+    """csv每行temperature,humidity,pressure，允许有表头"""
+    with open(path, newline='') as f:
+        for row in csv.reader(f):
+            # 空行和字段不足的行跳过
+            if len(row) < 3:
+                continue
+            try:
+                yield float(row[0]), float(row[1]), float(row[2])
+            except ValueError:
+                continue
+
+
+def iter_packed_readings(path):
+    """内存映射读取连续的<3d二进制记录，不需要把文件全部读入内存"""
+    with open(path, 'rb') as f:
+        if f.seek(0, 2) == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            end = len(m) - len(m) % PACKED_READING.size
+            view = memoryview(m)[:end]
+            try:
+                yield from PACKED_READING.iter_unpack(view)
+            finally:
+                view.release()
+
+
+def write_packed_readings(path, readings):
+    with open(path, 'wb') as f:
+        for reading in readings:
+            f.write(PACKED_READING.pack(*reading))
+
+
+# 每个观察者都会收到所有更新，即使只关心气压或者只关心大于0.5度的变化
+# 解决：订阅时声明关心的字段和变化阈值，主题维护字段到订阅的索引，只通知相关的观察者
+class Subscription(object):
+    def __init__(self, observer, fields, thresholds):
+        self.observer = observer
+        self.fields = fields
+        # field -> 最小变化量，0表示有变化就通知
+        self.thresholds = thresholds
+        # 上次通知给该观察者的值
+        self.last = None
+
+    def interested(self, values):
+        if self.last is None:
+            return True
+        for field in self.fields:
+            new, old = values[field], self.last[field]
+            if new == old:
+                continue
+            if new is None or old is None or abs(new - old) >= self.thresholds.get(field, 0):
+                return True
+        return False
+
+
+class FilteredWeatherData(EndWeatherData):
+    fields = ('temperature', 'humidity', 'pressure')
+
+    def __init__(self):
+        super(FilteredWeatherData, self).__init__()
+        self.subscriptions = {}
+        # field -> {id(observer): subscription}
+        self.index = {field: {} for field in self.fields}
+        self.last_values = None
+
+    def add_observer(self, observer, fields=None, thresholds=None):
+        """fields默认全部字段，thresholds如{'temperature': 0.5}"""
+        thresholds = thresholds or {}
+        fields = tuple(fields or self.fields)
+        for field in tuple(fields) + tuple(thresholds):
+            if field not in self.fields:
+                raise ValueError(f'unknown field: {field}')
+        subscription = Subscription(observer, fields, thresholds)
+        self.subscriptions[id(observer)] = subscription
+        for field in fields:
+            self.index[field][id(observer)] = subscription
+        self.observers.append(observer)
+        print(f'{observer} added')
+
+    def delete_observer(self, observer):
+        subscription = self.subscriptions.pop(id(observer))
+        for field in subscription.fields:
+            del self.index[field][id(observer)]
+        self.observers.remove(observer)
+        print(f'{observer} deleted')
+
+    def match(self, values):
+        """返回这次读数需要通知的订阅，并记录为已通知"""
+        if self.last_values is None:
+            changed_fields = self.fields
+        else:
+            changed_fields = [field for field in self.fields if values[field] != self.last_values[field]]
+        self.last_values = values
+        # 只访问关心变化字段的订阅，dict合并去重
+        candidates = {}
+        for field in changed_fields:
+            candidates.update(self.index[field])
+        matched = []
+        for subscription in list(candidates.values()):
+            if subscription.interested(values):
+                subscription.last = values
+                matched.append(subscription)
+        return matched
+
+    def notify_observers(self):
+        if self.changed:
+            values = {'temperature': self.get_temperature(),
+                      'humidity': self.get_humidity(),
+                      'pressure': self.get_pressure()}
+            self.changed = False
+            for subscription in self.match(values):
+                if self.instrumentation is None:
+                    subscription.observer.update(values['temperature'], values['humidity'], values['pressure'])
+                else:
+                    self.instrumentation.call(subscription.observer, values['temperature'],
+                                              values['humidity'], values['pressure'])
+
+    def set_changed_many(self, readings, batch_size=1024):
+        """逐条按字段和阈值过滤，每个观察者收到的是过滤后属于自己的批次"""
+        readings = iter(readings)
+        while True:
+            batch = list(itertools.islice(readings, batch_size))
+            if not batch:
+                break
+            # id(subscription) -> (subscription, 读数列表)
+            deliveries = {}
+            for reading in batch:
+                values = dict(zip(self.fields, reading))
+                for subscription in self.match(values):
+                    deliveries.setdefault(id(subscription), (subscription, []))[1].append(reading)
+            self.temperature, self.humidity, self.pressure = batch[-1]
+            for subscription, readings_batch in deliveries.values():
+                self.deliver_batch(subscription.observer, readings_batch)
+        self.changed = False
+
+
+# 预报等计算密集的公告板受GIL限制，线程池也无法利用多核
+# 解决：观察者放到子进程执行，读数通过共享内存传递，不用每个观察者pickle一次
+def _process_observer_worker(factory, slot_names, tasks, free_slots):
+    observer = factory()
+    slots = [shared_memory.SharedMemory(name=name) for name in slot_names]
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            slot, count = task
+            values = slots[slot].buf.cast('d')
+            try:
+                flat = values[:count * 3].tolist()
+            finally:
+                values.release()
+            free_slots.put(slot)
+            batch = list(zip(flat[0::3], flat[1::3], flat[2::3]))
+            # 一批出错只打印，子进程退出会让主进程等不到空闲槽
+            try:
+                update_many = getattr(observer, 'update_many', None)
+                if update_many is not None:
+                    update_many(batch)
+                else:
+                    for reading in batch:
+                        observer.update(*reading)
+            except Exception as e:
+                print(f'{observer} update error: {e!r}')
+    finally:
+        for shm in slots:
+            shm.close()
+
+
+class ProcessObserverHost(object):
+    """
+    在子进程中运行factory()创建的观察者，对主题来说它就是普通观察者
+    读数写入共享内存槽，子进程处理慢时slots用完会阻塞，起到背压作用
+    子进程意外退出时，等待空闲槽的update抛出RuntimeError，并释放共享内存
+    """
+
+    def __init__(self, factory, capacity=4096, slots=2, context=None, poll_interval=0.1):
+        self.name = getattr(factory, '__name__', str(factory))
+        self.capacity = capacity
+        # 等待空闲槽时每隔多久检查一次子进程是否还活着
+        self.poll_interval = poll_interval
+        ctx = context or multiprocessing.get_context()
+        self.slots = [shared_memory.SharedMemory(create=True, size=capacity * 3 * 8) for _ in range(slots)]
+        self.tasks = ctx.Queue()
+        self.free_slots = ctx.Queue()
+        for i in range(slots):
+            self.free_slots.put(i)
+        self.process = ctx.Process(target=_process_observer_worker,
+                                   args=(factory, [shm.name for shm in self.slots], self.tasks, self.free_slots),
+                                   daemon=True)
+        self.process.start()
+
+    def update(self, temperature, humidity, pressure):
+        self.update_many([(temperature, humidity, pressure)])
+
+    def update_many(self, batch):
+        for start in range(0, len(batch), self.capacity):
+            chunk = batch[start:start + self.capacity]
+            slot = self._get_free_slot()
+            values = self.slots[slot].buf.cast('d')
+            try:
+                values[:len(chunk) * 3] = array.array('d', itertools.chain.from_iterable(chunk))
+            finally:
+                values.release()
+            self.tasks.put((slot, len(chunk)))
+
+    def _get_free_slot(self):
+        while True:
+            if not self.slots:
+                raise RuntimeError(f'{self} is closed')
+            try:
+                return self.free_slots.get(timeout=self.poll_interval)
+            except queue.Empty:
+                if not self.process.is_alive():
+                    self._release()
+                    raise RuntimeError(f'{self} worker exited with code {self.process.exitcode}')
+
+    def _release(self):
+        for shm in self.slots:
+            shm.close()
+            shm.unlink()
+        self.slots = []
+
+    def close(self):
+        """等待子进程处理完已提交的读数后退出"""
+        if self.process.is_alive():
+            self.tasks.put(None)
+        self.process.join()
+        self._release()
+
+    def __str__(self):
+        return f'Process({self.name})'
+
+
+# 一个慢的公告板会拖住后面所有公告板，通知耗时是所有观察者之和
+# 解决：asyncio版本的主题，并发通知，耗时由最慢的观察者决定
+class AsyncSubjectMixin(object):
+    async def add_observer(self, observer):
+        raise NotImplementedError
+
+    async def delete_observer(self, observer):
+        raise NotImplementedError
+
+    async def notify_observers(self):
+        raise NotImplementedError
+
+
+class AsyncEndWeatherData(AsyncSubjectMixin):
+    """
+    协程观察者直接await，普通观察者丢到executor中执行
+    每个观察者单独超时，超时或异常不影响其他观察者
+    """
+
+    def __init__(self, timeout=1.0, executor=None):
+        self.observers = []
+        # observer -> 超时时间，没有单独设置的使用默认值
+        self.timeouts = {}
+        self.timeout = timeout
+        # None为loop默认的线程池
+        self.executor = executor
+        self.changed = False
+        self.temperature = None
+        self.humidity = None
+        self.pressure = None
+
+    async def add_observer(self, observer, timeout=None):
+        self.observers.append(observer)
+        if timeout is not None:
+            self.timeouts[observer] = timeout
+        print(f'{observer} added')
+
+    async def delete_observer(self, observer):
+        self.observers.remove(observer)
+        self.timeouts.pop(observer, None)
+        print(f'{observer} deleted')
+
+    async def _update(self, observer, temperature, humidity, pressure):
+        if asyncio.iscoroutinefunction(observer.update):
+            coro = observer.update(temperature, humidity, pressure)
+        else:
+            loop = asyncio.get_running_loop()
+            coro = loop.run_in_executor(self.executor, observer.update, temperature, humidity, pressure)
+        timeout = self.timeouts.get(observer, self.timeout)
+        try:
+            await asyncio.wait_for(coro, timeout)
+        except asyncio.TimeoutError:
+            # executor中的线程无法取消，只是不再等待它
+            print(f'{observer} update timeout')
+        except Exception as e:
+            print(f'{observer} update error: {e!r}')
+
+    async def notify_observers(self):
+        if self.changed:
+            temperature = self.get_temperature()
+            humidity = self.get_humidity()
+            pressure = self.get_pressure()
+            self.changed = False
+            # 复制一份，通知过程中增删观察者不影响本次通知
+            observers = list(self.observers)
+            await asyncio.gather(*(self._update(observer, temperature, humidity, pressure)
+                                   for observer in observers))
+
+    async def measure_changed(self):
+        await self.notify_observers()
+
+    def get_temperature(self):
+        return self.temperature
+
+    def get_humidity(self):
+        return self.humidity
+
+    def get_pressure(self):
+        return self.pressure
+
+    async def set_changed(self, temperature, humidity, pressure):
+        self.temperature = temperature
+        self.humidity = humidity
+        self.pressure = pressure
+        self.changed = True
+        await self.measure_changed()
+
+
+class AsyncForecast(object):
+    """协程观察者"""
+
+    async def update(self, temperature, humidity, pressure):
+        await asyncio.sleep(0.1)
+        print(f'Async Forecast: temperature:{temperature}, humidity:{humidity}, pressure:{pressure}')
+
+    def __str__(self):
+        return 'AsyncForecast'
+
+
+# 同步通知时一个卡住的观察者会卡住set_changed
+# 解决：丢到线程池执行，每个观察者有自己的有界队列，队列满了只丢弃自己的更新
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+BLOCK = 'block'
+
+
+class ObserverMailbox(object):
+    """单个观察者的待处理队列，同一观察者的更新按顺序串行执行"""
+
+    def __init__(self, observer, executor, max_pending, policy, subject=None):
+        self.observer = observer
+        # 用于读取主题的耗时统计
+        self.subject = subject
+        self.executor = executor
+        self.max_pending = max_pending
+        self.policy = policy
+        self.pending = collections.deque()
+        self.condition = threading.Condition()
+        # 是否已经有任务在线程池中消费队列
+        self.running = False
+        self.dropped = 0
+
+    def put(self, values):
+        with self.condition:
+            if len(self.pending) >= self.max_pending:
+                if self.policy == DROP_OLDEST:
+                    self.pending.popleft()
+                    self.dropped += 1
+                elif self.policy == DROP_NEWEST:
+                    self.dropped += 1
+                    return
+                else:
+                    while len(self.pending) >= self.max_pending:
+                        self.condition.wait()
+            self.pending.append(values)
+            if not self.running:
+                self.running = True
+                self.executor.submit(self.drain)
+
+    def drain(self):
+        while True:
+            with self.condition:
+                if not self.pending:
+                    self.running = False
+                    return
+                values = self.pending.popleft()
+                self.condition.notify()
+            try:
+                instrumentation = self.subject.instrumentation if self.subject is not None else None
+                if instrumentation is None:
+                    self.observer.update(*values)
+                else:
+                    instrumentation.call(self.observer, *values)
+            except Exception as e:
+                print(f'{self.observer} update error: {e!r}')
+
+
+class ThreadPoolWeatherData(EndWeatherData):
+    """
+    通知交给线程池，set_changed不再等待观察者
+    policy: DROP_OLDEST, DROP_NEWEST, BLOCK
+    """
+
+    def __init__(self, max_workers=None, max_pending=16, policy=DROP_OLDEST, executor=None):
+        super(ThreadPoolWeatherData, self).__init__()
+        if policy not in (DROP_OLDEST, DROP_NEWEST, BLOCK):
+            raise ValueError(f'unknown policy: {policy}')
+        self.executor = executor or ThreadPoolExecutor(max_workers=max_workers)
+        self.max_pending = max_pending
+        self.policy = policy
+        self.mailboxes = {}
+
+    def add_observer(self, observer):
+        self.mailboxes[observer] = ObserverMailbox(observer, self.executor, self.max_pending, self.policy, self)
+        super(ThreadPoolWeatherData, self).add_observer(observer)
+
+    def delete_observer(self, observer):
+        super(ThreadPoolWeatherData, self).delete_observer(observer)
+        del self.mailboxes[observer]
+
+    def notify_observers(self):
+        if self.changed:
+            values = (self.get_temperature(), self.get_humidity(), self.get_pressure())
+            self.changed = False
+            for mailbox in list(self.mailboxes.values()):
+                mailbox.put(values)
+
+    def set_changed_many(self, readings, batch_size=1024):
+        """每条读数进入各观察者的队列，仍然按队列的溢出策略处理，观察者在线程池中逐条update"""
+        for temperature, humidity, pressure in readings:
+            self.temperature, self.humidity, self.pressure = temperature, humidity, pressure
+            values = (temperature, humidity, pressure)
+            for mailbox in list(self.mailboxes.values()):
+                mailbox.put(values)
+        self.changed = False
+
+    def dropped(self, observer):
+        return self.mailboxes[observer].dropped
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+
+# 高频传感器每次set_changed都全量通知，changed标记并没有起到节流作用
+# 解决：合并变化，只通知最新值，每interval秒或每every次更新最多通知一次
+class CoalescingWeatherData(EndWeatherData):
+    """
+    interval: 两次通知的最小间隔(秒)，None表示不按时间
+    every: 累计多少次更新通知一次，None表示不按次数
+    两者都设置时满足任一条件即通知
+    按时间合并时，窗口内被压下的最新值会在窗口结束时由定时器发出，也可以随时flush
+    """
+
+    def __init__(self, interval=None, every=None):
+        super(CoalescingWeatherData, self).__init__()
+        if interval is None and every is None:
+            raise ValueError('interval and every cannot both be None')
+        self.interval = interval
+        self.every = every
+        self.pending_count = 0
+        self.last_notify = None
+        # 定时器线程也会通知，和set_changed互斥
+        self.lock = threading.RLock()
+        self.timer = None
+
+    def set_changed(self, temperature, humidity, pressure):
+        with self.lock:
+            super(CoalescingWeatherData, self).set_changed(temperature, humidity, pressure)
+
+    def measure_changed(self):
+        self.pending_count += 1
+        if self.every is not None and self.pending_count >= self.every:
+            self.flush()
+        elif self.interval is not None:
+            elapsed = None if self.last_notify is None else time.monotonic() - self.last_notify
+            if elapsed is None or elapsed >= self.interval:
+                self.flush()
+            elif self.timer is None:
+                # 窗口结束时发出最新值
+                self.timer = threading.Timer(self.interval - elapsed, self._trailing_flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def _trailing_flush(self):
+        with self.lock:
+            # 等锁期间已经被flush取消或者换成了新的定时器
+            if self.timer is not threading.current_thread():
+                return
+            self.timer = None
+            self.flush()
+
+    def flush(self):
+        """立即把最新值通知出去，没有未通知的变化则什么都不做"""
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if self.changed:
+                self.notify_observers()
+                self.pending_count = 0
+                self.last_notify = time.monotonic()
+
+    def close(self):
+        """发出未通知的值，并停止定时器"""
+        self.flush()
+
+
+class SlowForecast(StartForecast):
+    def update(self, temperature, humidity, pressure):
+        time.sleep(0.1)
+        super(SlowForecast, self).update(temperature, humidity, pressure)
+
+    def __str__(self):
+        return 'SlowForecast'
+
+
+# observers是list，delete_observer是O(n)，忘记取消订阅的公告板永远不会被回收
+# 解决：基于dict(有序)和弱引用的注册表，O(1)增删，被回收的观察者自动移除
+class WeakObserverRegistry(object):
+    def __init__(self):
+        # id(observer) -> weakref，dict保持插入顺序
+        self.refs = {}
+
+    def add(self, observer):
+        key = id(observer)
+        if key in self.refs and self.refs[key]() is observer:
+            return
+        self.refs[key] = weakref.ref(observer, self._make_remover(key))
+
+    def _make_remover(self, key):
+        refs = self.refs
+
+        def remove(ref):
+            # id可能已被新对象复用，只删除自己那一项
+            if refs.get(key) is ref:
+                del refs[key]
+        return remove
+
+    def remove(self, observer):
+        key = id(observer)
+        ref = self.refs.get(key)
+        if ref is None or ref() is not observer:
+            raise ValueError(f'{observer} not registered')
+        del self.refs[key]
+
+    def __contains__(self, observer):
+        ref = self.refs.get(id(observer))
+        return ref is not None and ref() is observer
+
+    def __len__(self):
+        return len(self.refs)
+
+    def __iter__(self):
+        # 先拿快照，通知过程中增删观察者不会影响本轮遍历
+        for ref in list(self.refs.values()):
+            observer = ref()
+            if observer is not None:
+                yield observer
+
+
+class WeakEndWeatherData(EndWeatherData):
+    def __init__(self):
+        super(WeakEndWeatherData, self).__init__()
+        self.observers = WeakObserverRegistry()
+
+    def add_observer(self, observer):
+        self.observers.add(observer)
+        print(f'{observer} added')
+
+    def delete_observer(self, observer):
+        self.observers.remove(observer)
+        print(f'{observer} deleted')
+
 
 @start_end
 def start_main():
@@ -170,6 +1105,152 @@ def end_main():
     weather.set_changed(1000, 2000, 3000)
 
 
+@start_end
+def async_main():
+    async def main():
+        weather = AsyncEndWeatherData(timeout=0.5)
+        await weather.add_observer(StartCurrent())
+        await weather.add_observer(StartStatistics())
+        await weather.add_observer(AsyncForecast())
+        # 两个慢公告板并发执行，总耗时约0.1s而不是0.2s
+        await weather.add_observer(AsyncForecast(), timeout=0.05)
+        await weather.set_changed(1, 2, 3)
+        await weather.set_changed(10, 20, 30)
+
+    asyncio.run(main())
+
+
+@start_end
+def thread_pool_main():
+    weather = ThreadPoolWeatherData(max_workers=4, max_pending=2, policy=DROP_OLDEST)
+    forecast = SlowForecast()
+    weather.add_observer(StartCurrent())
+    weather.add_observer(forecast)
+    for i in range(5):
+        weather.set_changed(i, i * 10, i * 100)
+        time.sleep(0.01)
+    weather.shutdown()
+    # 慢公告板只丢自己的更新
+    print(f'{forecast} dropped {weather.dropped(forecast)}')
+
+
+@start_end
+def coalescing_main():
+    weather = CoalescingWeatherData(every=1000)
+    weather.add_observer(StartCurrent())
+    for i in range(2500):
+        weather.set_changed(i, i * 10, i * 100)
+    # 只通知了2次，最后500次更新的最新值手动flush
+    weather.flush()
+
+    weather = CoalescingWeatherData(interval=0.05)
+    weather.add_observer(StartCurrent())
+    for i in range(100):
+        weather.set_changed(i, i * 10, i * 100)
+    # 第一次立即通知，窗口内的最新值在窗口结束时发出
+    time.sleep(0.1)
+
+
+@start_end
+def ring_statistics_main():
+    weather = EndWeatherData()
+    statistics = RingStatistics(capacity=3, window=2)
+    weather.add_observer(statistics)
+    weather.set_changed(1, 2, 3)
+    weather.set_changed(10, 20, 30)
+    weather.set_changed(100, 200, 300)
+    weather.set_changed(1000, 2000, 3000)
+    print(statistics.rolling('pressure'))
+
+
+@start_end
+def weak_main():
+    weather = WeakEndWeatherData()
+    current = StartCurrent()
+    weather.add_observer(current)
+    weather.add_observer(StartForecast())
+    # 没有其他引用的Forecast已经被回收
+    weather.set_changed(1, 2, 3)
+    weather.delete_observer(current)
+    print(f'observers: {len(weather.observers)}')
+
+
+@start_end
+def filtered_main():
+    weather = FilteredWeatherData()
+    weather.add_observer(StartCurrent())
+    weather.add_observer(StartForecast(), fields=['pressure'])
+    weather.add_observer(StartStatistics(), fields=['temperature'], thresholds={'temperature': 0.5})
+    weather.set_changed(1, 2, 3)
+    # 只有Current收到
+    weather.set_changed(1.2, 3, 3)
+    # Current和Statistics收到，Statistics和上次通知的1比较
+    weather.set_changed(1.6, 3, 3)
+    # Current和Forecast收到
+    weather.set_changed(1.6, 3, 4)
+
+
+@start_end
+def bulk_main():
+    import os
+    import tempfile
+    weather = EndWeatherData()
+    weather.add_observer(RingStatistics())
+    weather.set_changed_many(((i, i * 10, i * 100) for i in range(5000)), batch_size=2000)
+    path = os.path.join(tempfile.mkdtemp(), 'readings.bin')
+    write_packed_readings(path, ((i, i * 10, i * 100) for i in range(3)))
+    weather.add_observer(StartCurrent())
+    weather.set_changed_many(iter_packed_readings(path))
+    os.remove(path)
+
+
+@start_end
+def process_main():
+    weather = EndWeatherData()
+    forecast = ProcessObserverHost(StartForecast)
+    weather.add_observer(forecast)
+    weather.set_changed(1, 2, 3)
+    weather.set_changed_many((i, i * 10, i * 100) for i in range(3))
+    forecast.close()
+
+
+@start_end
+def instrumentation_main():
+    weather = EndWeatherData()
+    weather.add_observer(StartCurrent())
+    weather.add_observer(SlowForecast())
+    instrumentation = weather.enable_instrumentation()
+    weather.set_changed(1, 2, 3)
+    weather.set_changed(10, 20, 30)
+    for name, stat in instrumentation.snapshot().items():
+        print(name, stat['calls'], stat['errors'], stat['latency']['p99_ns'])
+
+
+@start_end
+def incremental_forecast_main():
+    weather = EndWeatherData()
+    forecast = IncrementalForecast()
+    weather.add_observer(forecast)
+    weather.set_changed(20, 65, 30.4)
+    weather.set_changed(21, 70, 29.2)
+    state = forecast.checkpoint()
+    restored = IncrementalForecast()
+    restored.restore(state)
+    weather.delete_observer(forecast)
+    weather.add_observer(restored)
+    weather.set_changed(19, 90, 29.0)
+
+
 if __name__ == '__main__':
     start_main()
     end_main()
+    async_main()
+    thread_pool_main()
+    coalescing_main()
+    ring_statistics_main()
+    weak_main()
+    filtered_main()
+    bulk_main()
+    process_main()
+    instrumentation_main()
+    incremental_forecast_main()
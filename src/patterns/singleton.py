@@ -11,13 +11,22 @@ python的几种实现方式:
     1.1 工厂方法
     1.2 工厂方法，加锁
     1.3 工厂方法，加锁, 优化
-    2.使用模块, 线程安全的
+    2.使用模块, 线程安全的, 可以延迟到第一次访问时创建
     3.装饰器，也有线程问题
     4.使用__new__, 也有线程问题 
     5.metaclass, 也有线程问题 
+    6.线程安全的metaclass，每个类一把锁，创建后读取无锁
+    7.asyncio版本，并发等待者共享同一个初始化future
+    8.fork安全，子进程中重置锁和实例，可选通过共享内存在进程间共享只读实例
+    9.多例装饰器，按构造参数缓存，LRU/TTL淘汰
+    10.注册表，启动时按依赖关系在线程池中并行预热
 """
+import collections
+import os
+import struct
 import threading
 import time
+import weakref
 from src.utils import start_end
 
 
@@ -90,6 +99,107 @@ def base_lock_opt_task():
     print(obj)
 
 
+# fork之后子进程复制了父进程的锁(可能处于加锁状态)和实例持有的连接
+# 解决：register_at_fork，子进程中换新锁并丢弃实例，父进程中正在进行的构造不会带到子进程
+class ForkSafeSingleton(object):
+    """子类可以实现after_fork_in_child，在子进程中清理继承来的资源(不要关闭父进程还在用的连接)"""
+    instance = None
+    instance_lock = threading.Lock()
+    _classes = weakref.WeakSet()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # 每个子类自己的实例和锁
+        cls.instance = None
+        cls.instance_lock = threading.Lock()
+        ForkSafeSingleton._classes.add(cls)
+
+    def __init__(self):
+        time.sleep(0.1)
+
+    @classmethod
+    def get_instance(cls):
+        if not cls.instance:
+            with cls.instance_lock:
+                if not cls.instance:
+                    cls.instance = cls.create()
+        return cls.instance
+
+    @classmethod
+    def create(cls):
+        return cls()
+
+    def after_fork_in_child(self):
+        pass
+
+    @classmethod
+    def _after_fork_in_child(cls):
+        # _classes只登记了子类，直接使用ForkSafeSingleton时它自己的锁和实例也要重置
+        for klass in [ForkSafeSingleton] + list(ForkSafeSingleton._classes):
+            klass.instance_lock = threading.Lock()
+            instance = klass.__dict__.get('instance')
+            klass.instance = None
+            if instance is not None:
+                instance.after_fork_in_child()
+
+
+# 只在子进程中重置，fork前不去拿构造锁：
+# 构造A时会在A的锁里获取B，fork钩子按别的顺序拿锁就会死锁
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=ForkSafeSingleton._after_fork_in_child)
+
+
+class SharedSingleton(ForkSafeSingleton):
+    """
+    只读实例在进程间共享：主进程publish把实例pickle到共享内存，
+    worker进程get_instance时从共享内存加载，不再重复执行耗时的构造
+    """
+    shared_name = None
+    _shm = None
+    _header = struct.Struct('<Q')
+
+    @classmethod
+    def publish(cls):
+        """在主进程中调用，返回共享内存名称，调用方负责最后unlink"""
+        import pickle
+        from multiprocessing import shared_memory
+        data = pickle.dumps(cls.get_instance(), protocol=pickle.HIGHEST_PROTOCOL)
+        shm = shared_memory.SharedMemory(create=True, size=cls._header.size + len(data))
+        cls._header.pack_into(shm.buf, 0, len(data))
+        shm.buf[cls._header.size:cls._header.size + len(data)] = data
+        cls.shared_name = shm.name
+        cls._shm = shm
+        return shm.name
+
+    @classmethod
+    def unpublish(cls):
+        shm = cls._shm
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+            cls._shm = None
+            cls.shared_name = None
+
+    @classmethod
+    def create(cls):
+        if cls.shared_name is None:
+            return cls()
+        import pickle
+        from multiprocessing import shared_memory
+        shm = shared_memory.SharedMemory(name=cls.shared_name)
+        try:
+            size, = cls._header.unpack_from(shm.buf, 0)
+            return pickle.loads(shm.buf[cls._header.size:cls._header.size + size])
+        finally:
+            shm.close()
+
+
+class ForkSafeConfig(SharedSingleton):
+    def __init__(self):
+        super(ForkSafeConfig, self).__init__()
+        self.pid = os.getpid()
+
+
 class ModuleSingleton(object):
     """模块"""
 
@@ -97,7 +207,20 @@ class ModuleSingleton(object):
         time.sleep(0.1)
 
 
-module_singleton = ModuleSingleton()
+# module_singleton = ModuleSingleton()
+# 导入模块时就会创建，即使用不到也要付出构造的开销
+# 解决：模块级__getattr__，第一次访问时才创建，from ... import module_singleton用法不变
+_module_singleton_lock = threading.Lock()
+
+
+def __getattr__(name):
+    if name == 'module_singleton':
+        with _module_singleton_lock:
+            if 'module_singleton' not in globals():
+                # 存入模块全局变量，之后的访问不会再走__getattr__
+                globals()['module_singleton'] = ModuleSingleton()
+        return globals()['module_singleton']
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
 
 def singleton_decorator(cls):
@@ -112,6 +235,153 @@ def singleton_decorator(cls):
     return _singleton
 
 
+# singleton_decorator只以cls为key，忽略了构造参数，缓存也永远不会淘汰
+# 解决：多例，按规范化后的参数缓存实例，限制数量，LRU/TTL淘汰，淘汰时可以关闭实例
+def multiton_decorator(maxsize=128, ttl=None, on_evict=None):
+    """
+    maxsize: 最多缓存的实例数，None不限制，超过时淘汰最久未使用的
+    ttl: 实例存活秒数，None不过期，过期实例在再次访问或创建新实例时清理
+    on_evict: 实例被淘汰时调用on_evict(instance)，比如关闭连接
+    刚创建的实例不会被淘汰，所以maxsize至少为1，ttl必须大于0
+    """
+    if maxsize is not None and maxsize < 1:
+        raise ValueError(f'maxsize must be at least 1 or None, got {maxsize}')
+    if ttl is not None and ttl <= 0:
+        raise ValueError(f'ttl must be positive or None, got {ttl}')
+
+    def decorator(cls):
+        # 第一次调用时才取签名，避免导入模块时加载inspect
+        signature = None
+        # key -> instance，OrderedDict维护LRU顺序
+        _instances = collections.OrderedDict()
+        # key -> 创建时间，按创建顺序，用于清理过期实例
+        _created = collections.OrderedDict()
+        _lock = threading.Lock()
+        # 每个key一把创建锁，构造耗时的实例时不阻塞其他key
+        _key_locks = {}
+        _stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+        def _key(args, kwargs):
+            nonlocal signature
+            if signature is None:
+                import inspect
+                signature = inspect.signature(cls)
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            key = []
+            for name, value in bound.arguments.items():
+                parameter = signature.parameters[name]
+                if parameter.kind == parameter.VAR_KEYWORD:
+                    # **kwargs与传参顺序无关
+                    value = tuple(sorted(value.items()))
+                key.append((name, value))
+            key = tuple(key)
+            try:
+                hash(key)
+            except TypeError:
+                raise TypeError(f'{cls.__name__} arguments must be hashable to be cached: {key!r}') from None
+            return key
+
+        def _remove(key, evicted):
+            """需要持有_lock，被淘汰的实例放入evicted，在锁外关闭"""
+            evicted.append(_instances.pop(key))
+            del _created[key]
+            _stats['evictions'] += 1
+
+        def _sweep(evicted):
+            """清理过期实例，需要持有_lock"""
+            if ttl is None:
+                return
+            now = time.monotonic()
+            while _created:
+                key, created = next(iter(_created.items()))
+                if now - created < ttl:
+                    break
+                _remove(key, evicted)
+
+        def _get(key, evicted):
+            """命中返回实例，否则返回None，需要持有_lock"""
+            if key not in _instances:
+                return None
+            if ttl is not None and time.monotonic() - _created[key] >= ttl:
+                _remove(key, evicted)
+                return None
+            _instances.move_to_end(key)
+            return _instances[key]
+
+        def _close(evicted):
+            # 关闭实例可能比较慢，放到锁外面
+            if on_evict is not None:
+                for instance in evicted:
+                    on_evict(instance)
+
+        def _multiton(*args, **kwargs):
+            key = _key(args, kwargs)
+            evicted = []
+            with _lock:
+                instance = _get(key, evicted)
+                if instance is not None:
+                    _stats['hits'] += 1
+                else:
+                    key_lock = _key_locks.setdefault(key, threading.Lock())
+            _close(evicted)
+            if instance is not None:
+                return instance
+            evicted = []
+            try:
+                with key_lock:
+                    with _lock:
+                        instance = _get(key, evicted)
+                        if instance is not None:
+                            _stats['hits'] += 1
+                            return instance
+                        _stats['misses'] += 1
+                    instance = cls(*args, **kwargs)
+                    with _lock:
+                        # 先清理再插入，刚创建的实例在最后，不会被淘汰
+                        _sweep(evicted)
+                        _instances[key] = instance
+                        _created[key] = time.monotonic()
+                        while maxsize is not None and len(_instances) > maxsize:
+                            _remove(next(iter(_instances)), evicted)
+                return instance
+            finally:
+                with _lock:
+                    # 构造失败时也要删除，否则_key_locks会一直增长
+                    if _key_locks.get(key) is key_lock:
+                        del _key_locks[key]
+                _close(evicted)
+
+        def stats():
+            with _lock:
+                return dict(_stats, size=len(_instances))
+
+        def clear():
+            evicted = []
+            with _lock:
+                for key in list(_instances):
+                    _remove(key, evicted)
+            _close(evicted)
+
+        _multiton.stats = stats
+        _multiton.clear = clear
+        _multiton.__wrapped__ = cls
+        return _multiton
+
+    return decorator
+
+
+@multiton_decorator(maxsize=2, on_evict=lambda client: client.close())
+class TenantClient(object):
+    def __init__(self, tenant, timeout=10):
+        time.sleep(0.1)
+        self.tenant = tenant
+        self.timeout = timeout
+
+    def close(self):
+        print(f'{self.tenant} client closed')
+
+
 @singleton_decorator
 class DecoratorSingleton(object):
     def __init__(self):
@@ -144,6 +414,196 @@ class MetaclassSingleton(metaclass=SingletonMetaclass):
     pass
 
 
+# 上面几种要么有线程问题，要么只对手写的一个类加了锁
+# 解决：可复用的metaclass，每个类一把锁，已创建时无锁返回，创建时双重检查
+class ThreadSafeSingletonMetaclass(type):
+    _instances = {}
+    _locks = {}
+
+    def __call__(cls, *args, **kwargs):
+        # 快速路径：dict读取在GIL下是原子的，不需要加锁
+        instance = cls._instances.get(cls)
+        if instance is None:
+            # setdefault是原子的，并发时所有线程拿到同一把锁
+            lock = cls._locks.setdefault(cls, threading.Lock())
+            with lock:
+                instance = cls._instances.get(cls)
+                if instance is None:
+                    instance = super(ThreadSafeSingletonMetaclass, cls).__call__(*args, **kwargs)
+                    cls._instances[cls] = instance
+        return instance
+
+    def get_instance(cls, *args, **kwargs):
+        return cls(*args, **kwargs)
+
+    def clear_instance(cls):
+        """删除实例，下次访问重新创建，主要用于测试"""
+        with cls._locks.setdefault(cls, threading.Lock()):
+            cls._instances.pop(cls, None)
+
+
+class ThreadSafeSingleton(metaclass=ThreadSafeSingletonMetaclass):
+    def __init__(self):
+        time.sleep(0.1)
+
+
+def thread_safe_task():
+    obj = ThreadSafeSingleton.get_instance()
+    print(obj)
+
+
+# 几十个耗时的单例在启动后第一次使用时才串行创建
+# 解决：注册表，warm_up在线程池中并行创建所有单例，依赖的单例先创建，并返回每个的耗时
+class SingletonRegistry(object):
+    def __init__(self):
+        # cls -> 依赖的cls列表，dict保持注册顺序
+        self.dependencies = {}
+
+    def register(self, cls=None, depends_on=()):
+        """可以直接调用，也可以作为装饰器@registry.register(depends_on=[...])"""
+        def decorator(klass):
+            self.dependencies[klass] = list(depends_on)
+            return klass
+
+        if cls is None:
+            return decorator
+        return decorator(cls)
+
+    def _check(self):
+        for cls, deps in self.dependencies.items():
+            for dep in deps:
+                if dep not in self.dependencies:
+                    raise ValueError(f'{cls.__name__} depends on unregistered {dep.__name__}')
+        # 检查循环依赖
+        visiting, done = set(), set()
+
+        def visit(cls):
+            if cls in done:
+                return
+            if cls in visiting:
+                raise ValueError(f'circular dependency on {cls.__name__}')
+            visiting.add(cls)
+            for dep in self.dependencies[cls]:
+                visit(dep)
+            visiting.discard(cls)
+            done.add(cls)
+
+        for cls in self.dependencies:
+            visit(cls)
+
+    @staticmethod
+    def _build(cls):
+        start = time.perf_counter()
+        cls.get_instance()
+        return time.perf_counter() - start
+
+    def warm_up(self, max_workers=None):
+        """返回{类名: 创建耗时(秒)}，有单例创建失败时，等其他单例完成后抛出第一个异常"""
+        # 只在预热时用到线程池，导入模块时不加载concurrent.futures
+        from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+        self._check()
+        timings = {}
+        remaining = {cls: set(deps) for cls, deps in self.dependencies.items()}
+        error = None
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            running = {}
+
+            def submit_ready():
+                for cls, deps in list(remaining.items()):
+                    if not deps:
+                        del remaining[cls]
+                        running[executor.submit(self._build, cls)] = cls
+
+            submit_ready()
+            while running:
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    cls = running.pop(future)
+                    try:
+                        timings[cls.__name__] = future.result()
+                    except Exception as e:
+                        # 依赖它的单例不再创建
+                        error = error or e
+                        continue
+                    for deps in remaining.values():
+                        deps.discard(cls)
+                submit_ready()
+        if error is not None:
+            raise error
+        return timings
+
+
+registry = SingletonRegistry()
+
+
+@registry.register
+class ConfigSingleton(BaseLockOptSingleton):
+    # 每个类自己的锁，共用父类的锁会让并行创建变成串行
+    instance = None
+    instance_lock = threading.Lock()
+
+
+@registry.register(depends_on=[ConfigSingleton])
+class DatabaseSingleton(BaseLockOptSingleton):
+    instance = None
+    instance_lock = threading.Lock()
+
+    def __init__(self):
+        super(DatabaseSingleton, self).__init__()
+        self.config = ConfigSingleton.get_instance()
+
+
+@registry.register(depends_on=[ConfigSingleton])
+class CacheSingleton(BaseLockOptSingleton):
+    instance = None
+    instance_lock = threading.Lock()
+
+
+# asyncio服务里阻塞的构造函数会卡住事件循环，多个task同时获取还会重复创建
+# 解决：async get_instance，并发的调用共享一个正在进行的初始化future，失败时所有等待者都收到异常，下次调用重试
+class AsyncSingleton(object):
+    """子类实现async create()完成耗时的初始化"""
+    instance = None
+    pending = None
+
+    @classmethod
+    async def create(cls):
+        return cls()
+
+    @classmethod
+    async def get_instance(cls):
+        # 只判断cls自己的属性，子类不会拿到父类的实例
+        instance = cls.__dict__.get('instance')
+        if instance is not None:
+            return instance
+        # 只有用到时才导入asyncio，同步代码导入本模块不用付出这个开销
+        import asyncio
+        pending = cls.__dict__.get('pending')
+        if pending is None:
+            pending = asyncio.ensure_future(cls._initialize())
+            cls.pending = pending
+        # shield：某个等待者被取消不会取消共享的初始化
+        return await asyncio.shield(pending)
+
+    @classmethod
+    async def _initialize(cls):
+        try:
+            cls.instance = await cls.create()
+            return cls.instance
+        finally:
+            # 成功后走快速路径，失败后清空以便重试
+            cls.pending = None
+
+
+class AsyncIOSingleton(AsyncSingleton):
+    @classmethod
+    async def create(cls):
+        import asyncio
+        # 不阻塞事件循环的io
+        await asyncio.sleep(0.1)
+        return cls()
+
+
 @start_end
 def base_main():
     for i in range(10):
@@ -192,6 +652,56 @@ def metaclass_main():
     print(singleton_2)
 
 
+@start_end
+def thread_safe_main():
+    for i in range(10):
+        t = threading.Thread(target=thread_safe_task)
+        t.start()
+
+
+@start_end
+def async_main():
+    import asyncio
+
+    async def main():
+        objs = await asyncio.gather(*(AsyncIOSingleton.get_instance() for i in range(10)))
+        print(set(objs))
+
+    asyncio.run(main())
+
+
+@start_end
+def fork_main():
+    config = ForkSafeConfig.get_instance()
+    ForkSafeConfig.publish()
+    pid = os.fork()
+    if pid == 0:
+        # 子进程重新获取，从共享内存加载而不是复用父进程的对象
+        child_config = ForkSafeConfig.get_instance()
+        print(f'child: {child_config is config}, created in {child_config.pid}')
+        os._exit(0)
+    os.waitpid(pid, 0)
+    print(f'parent: {ForkSafeConfig.get_instance() is config}')
+    ForkSafeConfig.unpublish()
+
+
+@start_end
+def multiton_main():
+    a = TenantClient('a')
+    print(a is TenantClient('a', timeout=10))
+    TenantClient('b')
+    TenantClient('c')
+    print(TenantClient.stats())
+
+
+@start_end
+def warm_up_main():
+    start = time.perf_counter()
+    print(registry.warm_up())
+    # Database和Cache并行，总耗时约0.2s而不是0.3s
+    print('total: %.2fs' % (time.perf_counter() - start))
+
+
 if __name__ == '__main__':
     base_main()
     base_lock_main()
@@ -199,3 +709,8 @@ if __name__ == '__main__':
     decorator_main()
     new_main()
     metaclass_main()
+    thread_safe_main()
+    async_main()
+    fork_main()
+    multiton_main()
+    warm_up_main()
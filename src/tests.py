@@ -1,4 +1,9 @@
+import contextlib
+import io
+import json
+import sys
 import threading
+import time
 
 
 def module_singleton_task():
@@ -13,5 +18,353 @@ def test_module_singleton():
         t.start()
 
 
+def hammer(target, thread_count=64):
+    """所有线程在barrier处同时开始调用target，返回每个线程拿到的结果"""
+    barrier = threading.Barrier(thread_count)
+    results = [None] * thread_count
+
+    def task(i):
+        barrier.wait()
+        results[i] = target()
+
+    threads = [threading.Thread(target=task, args=(i,)) for i in range(thread_count)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def test_thread_safe_singleton_metaclass():
+    from src.patterns.singleton import ThreadSafeSingletonMetaclass
+
+    created = []
+
+    class Expensive(metaclass=ThreadSafeSingletonMetaclass):
+        def __init__(self):
+            created.append(self)
+            time.sleep(0.05)
+
+    for thread_count in (64, 128):
+        Expensive.clear_instance()
+        created.clear()
+        results = hammer(Expensive.get_instance, thread_count)
+        assert len(created) == 1
+        assert all(obj is created[0] for obj in results)
+
+
+def test_thread_safe_singleton_metaclass_per_class():
+    from src.patterns.singleton import ThreadSafeSingletonMetaclass
+
+    class First(metaclass=ThreadSafeSingletonMetaclass):
+        pass
+
+    class Second(metaclass=ThreadSafeSingletonMetaclass):
+        pass
+
+    class Child(First):
+        pass
+
+    results = hammer(lambda: (First(), Second(), Child()))
+    assert len({tuple(id(obj) for obj in objs) for objs in results}) == 1
+    first, second, child = results[0]
+    assert type(first) is First and type(second) is Second and type(child) is Child
+
+
+# 单例的基准测试和正确性检查
+# 每次运行都构造一个全新的类，所以不同运行之间互不影响
+def _sleep_init(init_delay):
+    def __init__(self):
+        time.sleep(init_delay)
+    return __init__
+
+
+def _fresh_base(base, init_delay):
+    cls = type(base.__name__, (base,), {'instance': None, '__init__': _sleep_init(init_delay)})
+    return cls.get_instance
+
+
+def _fresh_module(init_delay):
+    from src.patterns import singleton
+    # 删除已创建的实例，下一次访问重新走模块__getattr__
+    singleton.__dict__.pop('module_singleton', None)
+    return lambda: singleton.module_singleton
+
+
+def _fresh_decorator(init_delay):
+    from src.patterns.singleton import singleton_decorator
+    return singleton_decorator(type('DecoratorSingleton', (object,), {'__init__': _sleep_init(init_delay)}))
+
+
+def _fresh_new(init_delay):
+    from src.patterns.singleton import NewSingleton
+
+    def __new__(cls):
+        if not cls.instance:
+            time.sleep(init_delay)
+            cls.instance = object.__new__(cls)
+        return cls.instance
+
+    # NewSingleton的__new__没有io，把延迟放到判断和赋值之间
+    return type('NewSingleton', (NewSingleton,), {'instance': None, '__new__': __new__})
+
+
+def _fresh_metaclass(metaclass, init_delay):
+    return metaclass(metaclass.__name__, (object,), {'__init__': _sleep_init(init_delay)})
+
+
+def _fresh_thread_safe_metaclass(init_delay):
+    from src.patterns.singleton import ThreadSafeSingletonMetaclass
+    return _fresh_metaclass(ThreadSafeSingletonMetaclass, init_delay).get_instance
+
+
+def _fresh_multiton(init_delay):
+    from src.patterns.singleton import multiton_decorator
+    return multiton_decorator()(type('MultitonSingleton', (object,), {'__init__': _sleep_init(init_delay)}))
+
+
+def singleton_variants():
+    """名称 -> (fresh(init_delay)返回获取实例的函数, 是否应该线程安全)"""
+    from src.patterns import singleton
+    return {
+        'BaseSingleton': (lambda d: _fresh_base(singleton.BaseSingleton, d), False),
+        'BaseLockSingleton': (lambda d: _fresh_base(singleton.BaseLockSingleton, d), True),
+        'BaseLockOptSingleton': (lambda d: _fresh_base(singleton.BaseLockOptSingleton, d), True),
+        'ForkSafeSingleton': (lambda d: _fresh_base(singleton.ForkSafeSingleton, d), True),
+        'ModuleSingleton': (_fresh_module, True),
+        'DecoratorSingleton': (_fresh_decorator, False),
+        'NewSingleton': (_fresh_new, False),
+        'MetaclassSingleton': (lambda d: _fresh_metaclass(singleton.SingletonMetaclass, d), False),
+        'ThreadSafeSingletonMetaclass': (_fresh_thread_safe_metaclass, True),
+        'multiton_decorator': (_fresh_multiton, True),
+    }
+
+
+def run_singleton_benchmark(get_instance, thread_count, calls):
+    """
+    先让所有线程同时第一次获取，统计多创建的实例数；
+    再同时开始连续调用calls次，统计吞吐量(次/秒)和p99延迟(纳秒)
+    """
+    race_barrier = threading.Barrier(thread_count + 1)
+    bench_barrier = threading.Barrier(thread_count + 1)
+    latencies = [None] * thread_count
+    instances = [None] * thread_count
+
+    def task(i):
+        race_barrier.wait()
+        seen = {id(get_instance())}
+        timings = []
+        bench_barrier.wait()
+        for _ in range(calls):
+            start = time.perf_counter_ns()
+            obj = get_instance()
+            timings.append(time.perf_counter_ns() - start)
+            seen.add(id(obj))
+        latencies[i] = timings
+        instances[i] = seen
+
+    threads = [threading.Thread(target=task, args=(i,)) for i in range(thread_count)]
+    for t in threads:
+        t.start()
+    # SingletonMetaclass每次调用都会print，测试时屏蔽输出
+    with contextlib.redirect_stdout(io.StringIO()):
+        race_barrier.wait()
+        bench_barrier.wait()
+        start = time.perf_counter()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+    all_latencies = sorted(ns for timings in latencies for ns in timings)
+    return {
+        'threads': thread_count,
+        'calls': thread_count * calls,
+        'throughput': thread_count * calls / elapsed,
+        'p99_ns': all_latencies[min(len(all_latencies) - 1, int(len(all_latencies) * 0.99))],
+        'duplicates': len(set().union(*instances)) - 1,
+    }
+
+
+def benchmark_singletons(max_threads=64, calls=1000, init_delay=0.01, variants=None):
+    results = []
+    for name, (fresh, thread_safe) in (variants or singleton_variants()).items():
+        thread_count = 1
+        while thread_count <= max_threads:
+            result = run_singleton_benchmark(fresh(init_delay), thread_count, calls)
+            result.update(variant=name, thread_safe=thread_safe)
+            results.append(result)
+            thread_count *= 2
+    return results
+
+
+def test_singleton_duplicates():
+    for result in benchmark_singletons(max_threads=16, calls=50, init_delay=0.01):
+        if result['thread_safe']:
+            assert result['duplicates'] == 0, result
+        assert result['throughput'] > 0
+
+
+def _open_journal(path, stereo):
+    from src.patterns.command import (CommandJournal, StereoOffCommand, StereoOnCommand,
+                                      StereoVolumeCommand)
+    journal = CommandJournal(path)
+    for command_cls in (StereoOnCommand, StereoOffCommand, StereoVolumeCommand):
+        journal.register_command(command_cls)
+    journal.register_receiver('stereo', stereo)
+    return journal
+
+
+def _replay_volume(path, compact):
+    from src.patterns.command import Stereo
+    stereo = Stereo()
+    journal = _open_journal(path, stereo)
+    with contextlib.redirect_stdout(io.StringIO()):
+        if compact:
+            journal.compact()
+        journal.replay()
+    journal.close()
+    return stereo.volume
+
+
+def test_journal_compact_keeps_replay_state(tmp_path):
+    from src.patterns.command import (EXECUTE, UNDO, Stereo, StereoOffCommand, StereoOnCommand,
+                                      StereoVolumeCommand)
+    stereo = Stereo()
+    sequences = [
+        [(StereoVolumeCommand(stereo, 30), EXECUTE), (StereoOnCommand(stereo), EXECUTE),
+         (StereoOffCommand(stereo), EXECUTE)],
+        [(StereoOnCommand(stereo), EXECUTE), (StereoVolumeCommand(stereo, 30), EXECUTE),
+         (StereoOffCommand(stereo), EXECUTE), (StereoOffCommand(stereo), UNDO)],
+        [(StereoOffCommand(stereo), UNDO), (StereoVolumeCommand(stereo, 25), EXECUTE),
+         (StereoOnCommand(stereo), UNDO), (StereoVolumeCommand(stereo, 25), UNDO)],
+    ]
+    for i, sequence in enumerate(sequences):
+        path = str(tmp_path / ('commands-%s.journal' % i))
+        journal = _open_journal(path, stereo)
+        for command, action in sequence:
+            journal.append(command, action)
+        journal.close()
+        with open(path, 'rb') as f:
+            data = f.read()
+        expected = _replay_volume(path, compact=False)
+        with open(path, 'wb') as f:
+            f.write(data)
+        assert _replay_volume(path, compact=True) == expected, sequence
+
+
+def test_journal_truncates_torn_tail(tmp_path):
+    from src.patterns.command import Stereo, StereoVolumeCommand
+    path = str(tmp_path / 'commands.journal')
+    stereo = Stereo()
+    journal = _open_journal(path, stereo)
+    for volume in (5, 10, 15):
+        journal.append(StereoVolumeCommand(stereo, volume))
+    journal.close()
+    with open(path, 'rb') as f:
+        data = f.read()
+    # 最后一条记录只写了一半
+    with open(path, 'ab') as f:
+        f.write(data[:len(data) // 3 - 3])
+    journal = _open_journal(path, stereo)
+    with contextlib.redirect_stdout(io.StringIO()):
+        assert journal.replay() == 3
+    journal.close()
+    assert stereo.volume == 15
+    with open(path, 'rb') as f:
+        assert f.read() == data
+
+
+def test_flatten_matches_chain():
+    from src.patterns.decorator import (BubbleTea, Coconut, Coffee, CondimentDecorator, FruitTea, Grass,
+                                        Pudding, flatten)
+    for base in (BubbleTea, FruitTea):
+        chain = base()
+        for condiment in (Grass, Coconut, Coffee, Coconut, Pudding, Grass, Coconut):
+            chain = condiment(chain)
+            flat = flatten(chain)
+            assert flat.cost() == chain.cost()
+            assert flat.get_description() == chain.get_description()
+        # 编译后继续装饰再编译
+        chain = Pudding(Coffee(chain))
+        flat = flatten(Pudding(Coffee(flatten(chain.beverage.beverage))))
+        assert (flat.cost(), flat.get_description()) == (chain.cost(), chain.get_description())
+
+    class Boba(CondimentDecorator):
+        def __init__(self, beverage):
+            self.beverage = beverage
+
+        def get_description(self):
+            return self.beverage.get_description() + ', boba'
+
+        def cost(self):
+            return self.beverage.cost() + 1.00
+
+    try:
+        flatten(Grass(Boba(BubbleTea())))
+    except TypeError:
+        pass
+    else:
+        raise AssertionError('flatten should reject condiments without name and price')
+
+
+def test_describe_matches_chain():
+    from src.patterns.decorator import BubbleTea, Coconut, CondimentDecorator, Grass, describe, flatten
+
+    class Boba(CondimentDecorator):
+        name = 'boba'
+
+        def __init__(self, beverage):
+            self.beverage = beverage
+
+        def get_description(self):
+            return self.beverage.get_description() + ', ' + self.name
+
+    class Jelly(CondimentDecorator):
+        def __init__(self, beverage):
+            self.beverage = beverage
+
+        def get_description(self):
+            return self.beverage.get_description() + ', jelly'
+
+    chain = Coconut(Boba(Grass(Coconut(BubbleTea()))))
+    assert describe(chain, group=False) == chain.get_description()
+    assert describe(chain) == 'bubble tea, coconut x2, grass, boba'
+    flat = Grass(flatten(Coconut(Grass(BubbleTea()))))
+    assert describe(flat, group=False) == flat.get_description()
+    try:
+        describe(Jelly(BubbleTea()))
+    except TypeError:
+        pass
+    else:
+        raise AssertionError('describe should reject condiments without name')
+
+
+def test_catalog_swap_reprices_every_path():
+    from src.patterns.decorator import (BubbleTea, Coconut, CompactBeverage, Grass, catalog, default_pricer,
+                                        flatten)
+    chain = Coconut(Grass(Coconut(BubbleTea())))
+    flat = flatten(chain)
+    compact = CompactBeverage.from_chain(chain)
+    pricer = default_pricer()
+    old = catalog.snapshot
+    try:
+        catalog.update(coconut=10.0, **{'bubble tea': 16.0})
+        expected = 16.0 + 10.0 + 2.0 + 10.0
+        assert chain.cost() == flat.cost() == compact.cost() == expected
+        assert pricer.price_beverages([chain]) == [expected]
+        # 传入旧快照时整条链都按旧价格计算
+        assert chain.cost(old) == flat.cost(old) == compact.cost(old) == 15.0 + 3.5 + 2.0 + 3.5
+    finally:
+        catalog.load(old.prices)
+
+
 if __name__ == '__main__':
     test_module_singleton()
+    # python -m src.tests [最大线程数] [输出文件]
+    max_threads = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    output = sys.argv[2] if len(sys.argv) > 2 else 'singleton_benchmark.json'
+    benchmark_results = benchmark_singletons(max_threads=max_threads)
+    with open(output, 'w') as f:
+        json.dump(benchmark_results, f, indent=2)
+    for r in benchmark_results:
+        print('%-30s threads:%-4s throughput:%12.0f/s p99:%8sns duplicates:%s' % (
+            r['variant'], r['threads'], r['throughput'], r['p99_ns'], r['duplicates']))